@@ -1,15 +1,40 @@
+# The functions are type annotated so the module can be compiled to C with mypyc, the hardware and LSL
+# packages ship without type information:
+#   mypyc --ignore-missing-imports experiment_controller_JLU_study.py
 import zmq
 import time
 import random
+import os
 import sys
+import gc
+import threading
+from collections import deque
+from dataclasses import dataclass
+from typing import Callable, Optional
+import numpy as np
 from TactileComms import TactileComm
-from pylsl import StreamInfo, StreamOutlet, IRREGULAR_RATE
+from pylsl import StreamInfo, StreamOutlet, IRREGULAR_RATE, local_clock
 from pygame import mixer
-import RPi.GPIO as GPIO
+import gpiod
 
 # Setup the ZeroMQ socket for communication between processes
-zmq_socket = zmq.Context().socket(zmq.PUB)
-zmq_socket.bind("tcp://*:5556")  # Bind the socket to all interfaces on port 5556
+zmq_socket = zmq.Context().socket(zmq.XPUB)  # Publisher that also reports subscriptions
+zmq_socket.setsockopt(zmq.XPUB_VERBOSE, 1)  # Report every subscription, also repeated ones
+zmq_socket.setsockopt(zmq.SNDHWM, 1000)  # Bound the queue of each subscriber, commands past it are dropped silently
+zmq_socket.setsockopt(zmq.LINGER, 100)  # Give the final "all off" 100 ms to leave on close, then drop it
+zmq_socket.setsockopt(zmq.TCP_KEEPALIVE, 1)  # Detect dead robot connections
+zmq_socket.setsockopt(zmq.IMMEDIATE, 1)  # Only queue messages for completed connections
+zmq_socket.bind("ipc:///tmp/robot_control.sock")  # Bind a local socket for subscribers on this machine
+zmq_socket.bind("tcp://*:5556")  # Bind the socket to all interfaces on port 5556 for remote subscribers
+
+# Robot commands are sent as two bytes: (robot id, opcode), robot id 255 addresses all robots
+ALL_ROBOTS = 255
+OP_PAUSE = 1  # Pause a single robot
+OP_GO = 2  # Resume a single robot
+OP_ALL_ON = 3  # Start all robots
+OP_ALL_OFF = 4  # Stop all robots
+ALL_ON = bytes([ALL_ROBOTS, OP_ALL_ON])
+ALL_OFF = bytes([ALL_ROBOTS, OP_ALL_OFF])
 
 # Create LSL (Lab Streaming Layer) outlets for different data streams
 robot_state_stream = StreamOutlet(StreamInfo('robot_state', 'state', 1, IRREGULAR_RATE, 'int8', 'rob_state'))
@@ -17,17 +42,35 @@ robot_id_stream = StreamOutlet(StreamInfo('robot_id', 'state', 1, IRREGULAR_RATE
 cue_state_stream = StreamOutlet(StreamInfo('cue_state', 'state', 1, IRREGULAR_RATE, 'int8', 'cue_state'))
 user_stream = StreamOutlet(StreamInfo('user_input', 'state', 1, IRREGULAR_RATE, 'int8', 'user_input'))
 
-# Allow time for the socket to set up properly
-time.sleep(3)
+# Queue of (robot state, cue state, user input, timestamp) samples, pushed as chunks by the LSL thread
+lsl_period_ns = 10_000_000  # Sample the state streams every 10 ms
+lsl_push_interval = 0.1  # Push the queued samples every 100 ms
+lsl_max_chunk = 64  # Maximum number of samples per chunk
+lsl_queue: deque[tuple[int, int, int, float]] = deque(maxlen=4096)
+robot_state_buffer = np.empty((lsl_max_chunk, 1), dtype=np.int8)  # Chunk of robot states
+cue_state_buffer = np.empty((lsl_max_chunk, 1), dtype=np.int8)  # Chunk of cue states
+user_buffer = np.empty((lsl_max_chunk, 1), dtype=np.int8)  # Chunk of user inputs
+lsl_timestamps = np.empty(lsl_max_chunk)  # Capture time of each sample in the chunk
+
+# Wait until the first robot has subscribed (at most 3 seconds) instead of a fixed delay
+if zmq_socket.poll(3000, zmq.POLLIN):
+    zmq_socket.recv()  # Consume the subscription message
 
 # Setup the haptic vest communication via serial port
 haptic_vest = TactileComm(comport='/dev/ttyACM0', baudrate=115200)
 vibration_intensity = 40  # Set the intensity level for haptic feedback
 
+# Multi-dot call of the vest, sends the dots of a cue as one serial frame in TactileComm versions that provide it
+vest_submit_dots: Optional[Callable[..., object]] = getattr(haptic_vest, 'submit_dots', None)
+
 # Initialize the audio mixer with a specified buffer size
 mixer.init(buffer=4096)
 
-# Setup GPIO pins for buttons, using BCM pin numbering
+# Load the sounds once so playing a cue does not read and decode the WAV files again
+SINE = mixer.Sound('sine.wav')  # Audio cue
+WHITENOISE = mixer.Sound('whitenoise.wav')  # Background noise during the experiment
+
+# Setup GPIO pins for buttons, using BCM pin numbering (the line offsets of gpiochip0)
 buttons = {
     'experiment': 12,  # Button to select the experiment
     'tactile': 6,      # Button for tactile feedback trial
@@ -39,26 +82,187 @@ buttons = {
     'start': 21,       # Button to start specific experiments - Normally open
 }
 
-# Initialize GPIO mode and setup input pins with pull-down resistors
-GPIO.setmode(GPIO.BCM)
-for button in buttons.values():
-    GPIO.setup(button, GPIO.IN, pull_up_down=GPIO.PUD_DOWN)
+# Request all button lines from the GPIO character device with pull-down resistors and edge events
+chip = gpiod.Chip('gpiochip0')
+button_lines = chip.get_lines(list(buttons.values()))
+button_lines.request(consumer='experiment', type=gpiod.LINE_REQ_EV_BOTH_EDGES, flags=gpiod.LINE_REQ_FLAG_BIAS_PULL_DOWN)
+
+# Pins of the buttons handled by the edge callbacks
+BTN_USER = buttons['user']
+BTN_STOP = buttons['stop']
+BTN_START = buttons['start']
+
+# Bit of each button in the packed button mask, in the order of the requested lines
+button_masks = {name: 1 << index for index, name in enumerate(buttons)}
+
+def read_button_mask() -> int:
+    """
+    Read the levels of all buttons with a single call.
+
+    Returns:
+        int: Bitmask of the pressed buttons, see button_masks.
+    """
+    return sum(level << index for index, level in enumerate(button_lines.get_values()))
+
+# Button state cached by the GPIO edge callbacks, so the loops never poll the pins
+user_state: int = int(bool(read_button_mask() & button_masks['user']))  # Latest level of the user button
+stop_event = threading.Event()  # Set when the stop button is pressed
+start_event = threading.Event()  # Set when the start button is pressed
+bounce_ns = 20_000_000  # Presses of the same button within 20 ms are contact bounce
+last_press_ns: dict[int, int] = {}  # Time of the last accepted press of each button
+
+def _is_press(event) -> bool:
+    """
+    Check if an edge is a new press of a normally closed button (falling edge) and not contact bounce.
+
+    Args:
+        event (gpiod.LineEvent): Edge event read from the button line.
+
+    Returns:
+        bool: True if the edge is a new press.
+    """
+    now = time.monotonic_ns()
+    pin = event.source.offset()
+    if event.type != gpiod.LineEvent.FALLING_EDGE or now - last_press_ns.get(pin, 0) < bounce_ns:
+        return False
+    last_press_ns[pin] = now
+    return True
+
+def _on_user(event) -> None:
+    """
+    Cache the level of the user button on every edge.
+
+    Args:
+        event (gpiod.LineEvent): Edge event read from the button line.
+    """
+    global user_state
+    user_state = int(event.type == gpiod.LineEvent.RISING_EDGE)
+
+def _on_stop(event) -> None:
+    """
+    Flag a press of the stop button.
+
+    Args:
+        event (gpiod.LineEvent): Edge event read from the button line.
+    """
+    if _is_press(event):
+        stop_event.set()
+
+def _on_start(event) -> None:
+    """
+    Flag a press of the start button.
+
+    Args:
+        event (gpiod.LineEvent): Edge event read from the button line.
+    """
+    if _is_press(event):
+        start_event.set()
+
+# Callback for the edges of each button pin, the edges of the selection buttons are ignored
+edge_callbacks = {
+    BTN_USER: _on_user,
+    BTN_STOP: _on_stop,
+    BTN_START: _on_start,
+}
+
+def watch_buttons() -> None:
+    """
+    Wait for edges on all button lines with a single epoll and pass them to the callbacks.
+    """
+    while True:
+        signaled_lines = button_lines.event_wait(sec=1)
+        if signaled_lines is None:
+            continue  # No edge within the timeout
+        for line in signaled_lines:
+            callback = edge_callbacks.get(line.offset())
+            for event in line.event_read_multiple():
+                if callback:
+                    callback(event)
+
+# Deliver button changes through kernel edge events instead of polling
+threading.Thread(target=watch_buttons, daemon=True).start()
+
+@dataclass(slots=True)
+class ExpState:
+    """
+    State of the running experiment, shared by the trial functions and the experiment loop.
+    """
+    robot_state: int = -1  # State of the robot (-1 indicates not started)
+    cue_state: int = -1  # State of the cue (-1 indicates no cue emitted)
+    robot_stop_id: int = 0  # Identifier for the robot that is paused
+
+exp_state = ExpState()  # Current state of the experiment
 
 # Setup global experiment parameters
 num_robots = 10  # Number of robots involved in the experiment
-robot_state = -1  # Initial state of the robot (-1 indicates not started)
-cue_state = -1  # Initial state of the cue (-1 indicates no cue emitted)
 robot_stop_duration = 5  # Duration for which the robot should pause
-robot_stop_id = 0  # Identifier for the robot that is paused
 start_offset = 30  # Time before the first trial starts
 end_offset = 30    # Time to wait after the last trial
 stop_offset = 0.02  # Small pause before stopping the robot
 
+# Pause and go commands of every robot, built once instead of on every trial
+PAUSE_COMMANDS = [bytes([robot_id, OP_PAUSE]) for robot_id in range(num_robots)]
+GO_COMMANDS = [bytes([robot_id, OP_GO]) for robot_id in range(num_robots)]
+
 # Random interval settings for trials
 min_interval = 8  # Minimum time interval between trials
 max_interval = 12  # Maximum time interval between trials
+rng = np.random.default_rng()  # Random generator for the trial schedule
+
+# Real-time settings for the experiment process
+experiment_cpu = 3  # CPU core reserved for the experiment, isolate it with isolcpus=3 in /boot/cmdline.txt
+experiment_priority = 50  # SCHED_FIFO priority of the experiment process
+
+def set_realtime_priority() -> None:
+    """
+    Pin the process to the experiment core and run it with SCHED_FIFO priority.
+
+    Keeps running with the default scheduler if the settings are not permitted (e.g. not run as root).
+    """
+    try:
+        os.sched_setaffinity(0, {experiment_cpu})
+        os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(experiment_priority))
+    except (OSError, AttributeError) as error:
+        print(f'Real-time scheduling not available: {error}')
+
+def _send(message: bytes) -> None:
+    """
+    Publish a robot command without ever blocking the experiment loop.
+    The XPUB socket never blocks or raises here, a subscriber whose queue holds SNDHWM commands silently misses the command.
+
+    Args:
+        message (bytes): Two byte command (robot id, opcode).
+    """
+    zmq_socket.send(message, zmq.NOBLOCK)
 
-def generate_trials(num_rep=0, duration=0, start_offset=30, min_end_offset=10, cue_types=[0, 1, 2, 3], effect_types=[0, 1]):
+def stream_lsl_samples() -> None:
+    """
+    Drain the queued state samples into the LSL outlets, one chunk per stream (runs on its own thread).
+    """
+    while True:
+        count = 0
+        while lsl_queue and count < lsl_max_chunk:
+            robot, cue, user, timestamp = lsl_queue.popleft()
+            robot_state_buffer[count, 0] = robot
+            cue_state_buffer[count, 0] = cue
+            user_buffer[count, 0] = user
+            lsl_timestamps[count] = timestamp
+            count += 1
+
+        if count:
+            timestamps = lsl_timestamps[:count]
+            robot_state_stream.push_chunk(robot_state_buffer[:count], timestamps)
+            cue_state_stream.push_chunk(cue_state_buffer[:count], timestamps)
+            user_stream.push_chunk(user_buffer[:count], timestamps)
+        else:
+            time.sleep(lsl_push_interval)  # Let the samples of the next chunk accumulate
+
+# Push the LSL samples from a separate thread so the outlets never delay the experiment timing
+threading.Thread(target=stream_lsl_samples, daemon=True).start()
+
+Trial = tuple[int, int, int]  # Timestamp, cue type and effect type of a trial
+
+def generate_trials(num_rep: int = 0, duration: float = 0, start_offset: int = 30, min_end_offset: int = 10, cue_types: list[int] = [0, 1, 2, 3], effect_types: list[int] = [0, 1]) -> list[Trial]:
     """
     Generate a list of trials based on specified parameters.
 
@@ -73,216 +277,294 @@ def generate_trials(num_rep=0, duration=0, start_offset=30, min_end_offset=10, c
     Returns:
         list: List of generated trials with timestamps and cue/effect pairs.
     """
-    trials = []  # Initialize an empty list to hold the generated trials
-
     if num_rep:
         # Generate all combinations of cues and effects
         combinations = [(cue, effect) for cue in cue_types for effect in effect_types]
-        repeated_combinations = combinations * num_rep  # Repeat each combination num_rep times
-        random.shuffle(repeated_combinations)  # Shuffle the combinations for randomness
-
-        timestamp = start_offset  # Start timestamp for the first trial
-        for cue, effect in repeated_combinations:
-            trials.append((timestamp, cue, effect))  # Append the trial with its timestamp
-            inter_trial_interval = random.randint(min_interval, max_interval)  # Random interval
-            timestamp += inter_trial_interval  # Update the timestamp for the next trial
+        repeated_combinations = np.array(combinations * num_rep).reshape(-1, 2)  # Repeat each combination num_rep times
+        rng.shuffle(repeated_combinations)  # Shuffle the combinations for randomness
+        cues = repeated_combinations[:, 0]
+        effects = repeated_combinations[:, 1]
 
     else:
         # If no repetitions are specified, calculate the number of trials based on duration
-        num_rep = int((duration - start_offset - min_end_offset) / ((max_interval + min_interval) / 2))
-        timestamp = start_offset  # Start timestamp for the first trial
-        for _ in range(num_rep):
-            trials.append((timestamp, cue_types[0], 1))  # Default to the first cue type
-            inter_trial_interval = random.randint(min_interval, max_interval)  # Random interval
-            timestamp += inter_trial_interval  # Update the timestamp for the next trial
+        num_rep = max(int((duration - start_offset - min_end_offset) / ((max_interval + min_interval) / 2)), 0)
+        cues = np.full(num_rep, cue_types[0])  # Default to the first cue type
+        effects = np.ones(num_rep, dtype=int)
+
+    # Draw all random intervals at once and accumulate them into the trial timestamps
+    intervals = rng.integers(min_interval, max_interval + 1, size=len(cues))
+    timestamps = start_offset + np.cumsum(intervals) - intervals  # The first trial starts at start_offset
+    trials = list(zip(timestamps.tolist(), cues.tolist(), effects.tolist()))
 
     return trials  # Return the list of generated trials
 
-def emit_cue(trial):
+# Vest dots that vibrate for a tactile cue
+DOTS = (1, 4, 13, 16, 17, 20, 29, 32)
+
+def _noop() -> None:
+    """
+    Emit no cue.
+    """
+
+def _play_audio() -> None:
+    """
+    Play the audio cue.
+    """
+    mixer.Channel(1).play(SINE)
+
+def _play_tactile() -> None:
+    """
+    Emit haptic feedback through the vest on the cue dots.
+    """
+    if vest_submit_dots is not None:
+        vest_submit_dots(DOTS, 10, vibration_intensity)  # One serial frame for all dots
+    else:
+        for dot in DOTS:
+            haptic_vest.submit_dot(dot, 10, vibration_intensity)
+
+def _play_audio_tactile() -> None:
+    """
+    Play the audio cue together with the haptic feedback.
+    """
+    _play_audio()
+    _play_tactile()
+
+# Cue type -> (log label, cue action, cue state)
+CUE_ACTIONS = {
+    0: ("Cue 1 - None", _noop, 1),  # No cue
+    1: ("Cue 2 - Audio", _play_audio, 2),  # Audio cue
+    2: ("Cue 3 - Tactile", _play_tactile, 3),  # Tactile cue
+    3: ("Cue 4 - AudioTactile", _play_audio_tactile, 4),  # Combined audio and tactile cue
+}
+
+def emit_cue(trial: Trial) -> None:
     """
     Emit the specified cue based on the trial data.
 
     Args:
         trial (tuple): The trial data containing timestamp, cue type, and effect type.
     """
-    global cue_state  # Use the global cue_state variable
-
-    # Emit the cue based on its type
-    if trial[1] == 0:
-        print("Cue 1 - None")  # No cue
-        cue_state = 1  # Update the cue state
-    elif trial[1] == 1:
-        print("Cue 2 - Audio")  # Audio cue
-        mixer.Channel(1).play(mixer.Sound('sine.wav'))  # Play audio
-        cue_state = 2  # Update the cue state
-    elif trial[1] == 2:
-        print("Cue 3 - Tactile")  # Tactile cue
-        # Emit haptic feedback through the vest on specified dots
-        for dot in [1, 4, 13, 16, 17, 20, 29, 32]:
-            haptic_vest.submit_dot(dot, 10, vibration_intensity)
-        cue_state = 3  # Update the cue state
-    elif trial[1] == 3:
-        print("Cue 4 - AudioTactile")  # Combined audio and tactile cue
-        mixer.Channel(1).play(mixer.Sound('sine.wav'))  # Play audio
-        for dot in [1, 4, 13, 16, 17, 20, 29, 32]:
-            haptic_vest.submit_dot(dot, 10, vibration_intensity)  # Emit haptic feedback
-        cue_state = 4  # Update the cue state
+    # Look up and emit the cue based on its type
+    label, action, state = CUE_ACTIONS[trial[1]]
+    print(label)
+    action()
+    exp_state.cue_state = state  # Update the cue state
 
-def start_pause(trial):
+def start_pause(trial: Trial) -> None:
     """
     Start a pause for the robot based on the trial data.
 
     Args:
         trial (tuple): The trial data containing timestamp, cue type, and effect type.
     """
-    global robot_state, robot_stop_id  # Use global variables for robot state and stop ID
-
     if trial[2] == 1:  # Check if the effect type requires a pause
-        robot_stop_id = random.randint(0, num_robots - 1)  # Randomly select a robot to pause
-        zmq_socket.send_string(f"{robot_stop_id} pause")  # Send pause command to the robot
-        robot_id_stream.push_sample([robot_stop_id + 1])  # Push the robot ID to the LSL stream
-        print(f"{robot_stop_id} pause")  # Log the pause action
-        robot_state = 1  # Update robot state to paused
+        exp_state.robot_stop_id = random.randint(0, num_robots - 1)  # Randomly select a robot to pause
+        _send(PAUSE_COMMANDS[exp_state.robot_stop_id])  # Send pause command to the robot
+        robot_id_stream.push_sample([exp_state.robot_stop_id + 1])  # Push the robot ID to the LSL stream
+        print(f"{exp_state.robot_stop_id} pause")  # Log the pause action
+        exp_state.robot_state = 1  # Update robot state to paused
     else:
-        robot_stop_id = -1  # Reset stop ID if no pause is required
-        robot_state = 2  # Set robot state to running
+        exp_state.robot_stop_id = -1  # Reset stop ID if no pause is required
+        exp_state.robot_state = 2  # Set robot state to running
 
-def end_pause():
+def end_pause() -> None:
     """
     End the pause for the robot, allowing it to resume operation.
     """
-    global robot_state, cue_state, robot_stop_id  # Use global variables
+    if exp_state.robot_stop_id != -1:  # If a robot is currently paused
+        _send(GO_COMMANDS[exp_state.robot_stop_id])  # Send go command to resume
+        print(f"{exp_state.robot_stop_id} go")  # Log the resume action
 
-    if robot_stop_id != -1:  # If a robot is currently paused
-        zmq_socket.send_string(f"{robot_stop_id} go")  # Send go command to resume
-        print(f"{robot_stop_id} go")  # Log the resume action
+    exp_state.robot_state = 0  # Reset the robot state to idle
+    exp_state.cue_state = 0  # Reset the cue state
 
-    robot_state = 0  # Reset the robot state to idle
-    cue_state = 0  # Reset the cue state
-
-def run_experiment(num_rep=0, duration=0, cue=0):
+def run_experiment(num_rep: int = 0, duration: float = 0, cue: list[int] = [0, 1, 2, 3]) -> None:
     """
     Run the experiment based on specified parameters.
 
     Args:
         num_rep (int): Number of repetitions for each trial.
         duration (float): Duration of the experiment in seconds.
-        cue (int): Cue type to be used in the experiment.
+        cue (list): Cue types to be used in the experiment.
     """
-    global cue_state, robot_state  # Use global variables for state tracking
-
     # Generate the list of trials based on parameters
     trials = generate_trials(num_rep=num_rep, duration=duration, start_offset=start_offset, cue_types=cue)
 
     # Calculate the total experiment duration
+    experiment_duration: float
     if num_rep:
-        experiment_duration = trials[-1][0] + end_offset  # Last trial time plus end offset
+        experiment_duration = float(trials[-1][0] + end_offset)  # Last trial time plus end offset
     else:
         experiment_duration = duration  # Use the provided duration
 
     # Start playing white noise as background sound
-    mixer.Channel(0).play(mixer.Sound('whitenoise.wav'), -1)
-
-    # Initialize timing variables for the experiment
-    experiment_start_time = time.time()  # Record the start time
-    elapsed_time = 0  # Elapsed time since the start
-    elapsed_time_last = 0  # Last recorded elapsed time
-    trial_index = 0  # Current trial index
-    cue_emitted = False  # Flag to track if a cue has been emitted
-    robot_state = 0  # Initialize robot state to idle
-    cue_state = 0  # Initialize cue state to no cue emitted
+    mixer.Channel(0).play(WHITENOISE, -1)
 
-    last_lsl_time = 0  # Timing for LSL data push
+    # Initialize the state variables for the experiment
+    exp_state.robot_state = 0  # Initialize robot state to idle
+    exp_state.cue_state = 0  # Initialize cue state to no cue emitted
+    stop_event.clear()  # Ignore stop presses made before the experiment started
 
     # Start all robots by sending "on" command
-    zmq_socket.send_string("all on")
+    _send(ALL_ON)
 
     if num_rep:
         print('Started pip & pop', trials)  # Log if repetitions are specified
     else:
         print('Started Cue experiment', trials)  # Log if running a cue experiment
 
-    # Main experiment loop
-    while (time.time() - experiment_start_time) <= experiment_duration: 
-        # Push LSL data every 10 milliseconds
-        if time.time() - last_lsl_time >= 0.01:
-            robot_state_stream.push_sample([robot_state])  # Push current robot state
-            cue_state_stream.push_sample([cue_state])  # Push current cue state
-            user_stream.push_sample([GPIO.input(buttons['user'])])  # Push user input state
-            last_lsl_time = time.time()  # Update last LSL push time
-
-        # Calculate elapsed time since the start of the experiment
-        elapsed_time = time.time() - experiment_start_time
-
-        # Print the current elapsed time every second
-        if elapsed_time - elapsed_time_last > 1:
-            elapsed_time_last = elapsed_time
-            sys.stdout.write("\033[K")  # Clear the current line in the console
-            print("\r", int(elapsed_time), "\t", end="")  # Print the elapsed time
-
-        # Check if the experiment should be stopped
-        if GPIO.input(buttons['stop']) != 1:
-            print(f'Experiment stopped after {elapsed_time} seconds.')  # Log stop time
-            zmq_socket.send_string("all off")  # Stop all robots
-            return  # Exit the function
-
-        # Check if it's time to emit a cue
-        if trial_index < len(trials) and not cue_emitted and elapsed_time >= trials[trial_index][0]:
-            emit_cue(trials[trial_index])  # Emit the cue for the current trial
-            cue_emitted = True  # Set the cue emitted flag
-
-        # Pause the robot if it's time based on the trial data
-        elif trial_index < len(trials) and (elapsed_time) >= trials[trial_index][0] + stop_offset and not robot_state:
-            start_pause(trials[trial_index])  # Start the pause for the robot
-
-        # Resume the robot after the pause duration
-        elif trial_index < len(trials) and (elapsed_time) >= trials[trial_index][0] + stop_offset + robot_stop_duration:
-            end_pause()  # End the pause for the robot
-            trial_index += 1  # Increment to the next trial
-            cue_emitted = False  # Reset cue emitted flag for the next trial
-
-    print(f'Experiment ended after {elapsed_time} seconds.')  # Log the end time
-    zmq_socket.send_string("all off")  # Stop all robots
-
-def main():
+    # Precompute the cue, pause and resume time of every trial in integer nanoseconds
+    experiment_start_ns = time.monotonic_ns()  # Record the start time
+    trial_offsets_ns = np.array([0, stop_offset, stop_offset + robot_stop_duration]) * 1e9
+    trial_times_ns = np.array([trial[0] for trial in trials], dtype=np.int64).reshape(-1, 1) * 1_000_000_000
+    transitions: list[int] = (experiment_start_ns + trial_times_ns + trial_offsets_ns.astype(np.int64)).ravel().tolist()
+    transitions.append(experiment_start_ns + int(experiment_duration * 1e9))  # The experiment ends after the last transition
+
+    # Initialize the timing variables for the experiment
+    end_ns: int = transitions[-1]  # End of the experiment
+    step: int = 0  # Next trial transition: trial index * 3 + phase (0 cue, 1 pause, 2 resume)
+    next_lsl_ns: int = experiment_start_ns  # Push LSL data every 10 milliseconds
+    next_print_ns: int = experiment_start_ns + 1_000_000_000  # Print the elapsed time every second
+
+    # Disable automatic garbage collection so it cannot pause the loop, collect between trials instead
+    gc.disable()
+
+    try:
+        # Bind the functions used in the loop to locals to skip the global and attribute lookups
+        monotonic_ns = time.monotonic_ns
+        queue_sample = lsl_queue.append
+        stop_requested = stop_event.is_set
+        wait_for_stop = stop_event.wait
+
+        # Main experiment loop
+        while True:
+            now = monotonic_ns()  # Read the clock once per iteration
+
+            # Check if the experiment should be stopped
+            if stop_requested():
+                elapsed_time = (now - experiment_start_ns) / 1e9
+                print(f'Experiment stopped after {elapsed_time} seconds.')  # Log stop time
+                _send(ALL_OFF)  # Stop all robots
+                return  # Exit the function
+
+            if now >= end_ns:
+                break
+
+            if now >= next_lsl_ns:
+                queue_sample((exp_state.robot_state, exp_state.cue_state, user_state, local_clock()))  # Queue robot, cue and user states
+                next_lsl_ns += lsl_period_ns  # Advance from the deadline, not the wake-up time, so the cadence does not drift
+                if next_lsl_ns <= now:
+                    next_lsl_ns = now + lsl_period_ns  # Skip the ticks missed during a long cue or pause call
+
+            if now >= next_print_ns:
+                # Clear the line and print the elapsed time, through sys.stdout so it stays in order with the log messages
+                sys.stdout.write(f"\r\033[K{(next_print_ns - experiment_start_ns) // 1_000_000_000}\t")
+                sys.stdout.flush()
+                next_print_ns += 1_000_000_000
+
+            # Move the current trial to its next phase once the transition is due
+            if step < len(transitions) - 1 and now >= transitions[step]:
+                trial_index, phase = divmod(step, 3)
+                if phase == 0:
+                    emit_cue(trials[trial_index])  # Emit the cue for the current trial
+                elif phase == 1:
+                    start_pause(trials[trial_index])  # Start the pause for the robot
+                else:
+                    end_pause()  # End the pause for the robot
+                    gc.collect()  # Collect garbage in the gap before the next cue
+                step += 1
+
+            # Sleep until the next event is due, waking up early if the stop button is pressed
+            wait_for_stop(max(0, min(transitions[step], next_lsl_ns, next_print_ns) - monotonic_ns()) / 1e9)
+
+        elapsed_time = (time.monotonic_ns() - experiment_start_ns) / 1e9
+        print(f'Experiment ended after {elapsed_time} seconds.')  # Log the end time
+        _send(ALL_OFF)  # Stop all robots
+    finally:
+        gc.enable()  # Restore automatic garbage collection, also when the loop raises
+
+# Buttons that select the experiment started by the start button
+SELECTION_MASK = (button_masks['experiment'] | button_masks['training'] | button_masks['audio']
+                  | button_masks['multi'] | button_masks['tactile'])
+
+# Selection buttons -> experiment to run, in order of precedence when more buttons are pressed
+# (no pin is wired for a separate no cue button)
+EXPERIMENT_SELECTIONS: list[tuple[int, Callable[[], None]]] = [
+    (button_masks['experiment'] | button_masks['training'], lambda: run_experiment(num_rep=2, cue=[0, 1, 2, 3])),  # Training experiment
+    (button_masks['experiment'] | button_masks['audio'], lambda: run_experiment(num_rep=10, cue=[0, 1, 2, 3])),  # Audio experiment
+    (button_masks['multi'], lambda: run_experiment(duration=180, cue=[3])),  # Multi-cue experiment
+    (button_masks['tactile'], lambda: run_experiment(duration=180, cue=[2])),  # Tactile feedback experiment
+    (button_masks['audio'], lambda: run_experiment(duration=180, cue=[1])),  # Audio feedback experiment
+]
+
+def select_experiment(mask: int) -> Optional[Callable[[], None]]:
+    """
+    Find the experiment for the pressed selection buttons, the first selection with all its buttons pressed wins.
+
+    Args:
+        mask (int): Bitmask of the pressed selection buttons.
+
+    Returns:
+        Callable: Experiment to run, or None if no experiment is selected.
+    """
+    for selection, experiment in EXPERIMENT_SELECTIONS:
+        # The experiment button switches between the pip & pop and the cue experiments
+        if mask & selection == selection and (mask ^ selection) & button_masks['experiment'] == 0:
+            return experiment
+    return None
+
+# Pressed selection buttons -> experiment to run, precomputed for every combination of the buttons
+EXPERIMENTS: dict[int, Optional[Callable[[], None]]] = {
+    mask: select_experiment(mask) for mask in range(SELECTION_MASK + 1) if mask & SELECTION_MASK == mask
+}
+
+def main() -> None:
     """
     Main function to continuously check button inputs and run experiments as needed.
     """
+    set_realtime_priority()
+
+    # Bind the objects and functions used in the loop to locals
+    monotonic_ns = time.monotonic_ns
+    queue_sample = lsl_queue.append
+    noise_channel = mixer.Channel(0)
+    start_requested = start_event.is_set
+    stop_requested = stop_event.is_set
+    wait_for_start = start_event.wait
+
     try:
-        last_lsl_time = 0  # Initialize last LSL push time
+        next_lsl_ns = 0  # Initialize next LSL push time
         while True:
             # Push LSL data every 10 milliseconds
-            if time.time() - last_lsl_time >= 0.01:
-                robot_state_stream.push_sample([-1])  # Push a default state for robots
-                cue_state_stream.push_sample([-1])  # Push a default state for cues
-                user_stream.push_sample([GPIO.input(buttons['user'])])  # Push user input state
-                last_lsl_time = time.time()  # Update last LSL push time
+            now = monotonic_ns()
+            if now >= next_lsl_ns:
+                queue_sample((-1, -1, user_state, local_clock()))  # Queue default robot and cue states with the user input
+                next_lsl_ns += lsl_period_ns  # Advance from the deadline so the cadence does not drift
+                if next_lsl_ns <= now:
+                    next_lsl_ns = now + lsl_period_ns  # Resynchronize after an experiment or at startup
 
             # Pause the white noise if the experiment button is pressed
-            mixer.Channel(0).pause()
-            if GPIO.input(buttons['experiment']) == 1:
-                # Check button inputs to determine which experiment to start
-                if GPIO.input(buttons['start']) != 1 and GPIO.input(buttons['training']) == 1:
-                    run_experiment(num_rep=2, cue=[0, 1, 2, 3])  # Start training experiment
-                elif GPIO.input(buttons['start']) != 1 and GPIO.input(buttons['audio']) == 1:
-                    run_experiment(num_rep=10, cue=[0, 1, 2, 3])  # Start audio experiment
-            else:
-                # Check for other button presses to start different types of experiments
-                if GPIO.input(buttons['start']) != 1 and GPIO.input(buttons['multi']) == 1:
-                    run_experiment(duration=180, cue=[3])  # Multi-cue experiment
-                elif GPIO.input(buttons['start']) != 1 and GPIO.input(buttons['tactile']) == 1:
-                    run_experiment(duration=180, cue=[2])  # Tactile feedback experiment
-                elif GPIO.input(buttons['start']) != 1 and GPIO.input(buttons['audio']) == 1:
-                    run_experiment(duration=180, cue=[1])  # Audio feedback experiment
-                elif GPIO.input(buttons['start']) != 1 and GPIO.input(buttons['none']) == 1:
-                    run_experiment(duration=180, cue=[0])  # No cue experiment
+            noise_channel.pause()
+            if start_requested():
+                # Look up the experiment for the pressed selection buttons
+                selection = read_button_mask() & SELECTION_MASK
+                experiment = EXPERIMENTS[selection]
+                if experiment:
+                    experiment()
+                else:
+                    print(f'No experiment selected by the buttons {selection:#b}')
+                start_event.clear()  # Drop start presses made while an experiment was running
 
             # Check if the stop button is pressed to stop all robots
-            if GPIO.input(buttons['stop']) != 1:
-                zmq_socket.send_string("all off")  # Stop all robots
+            if stop_requested():
+                stop_event.clear()
+                _send(ALL_OFF)  # Stop all robots
+
+            # Sleep until the next LSL push is due or the start button is pressed
+            wait_for_start(max(0, next_lsl_ns - monotonic_ns()) / 1e9)
 
     except KeyboardInterrupt:
-        zmq_socket.send_string("all off")  # Stop all robots on interrupt
+        _send(ALL_OFF)  # Stop all robots on interrupt
         zmq_socket.close()  # Close the ZeroMQ socket
 
 if __name__ == '__main__':
@@ -2,15 +2,30 @@ import zmq
 import time
 import random
 import sys
+import os
+import threading
+import heapq
+from collections import deque
+import numpy as np
 from TactileComms import TactileComm
-from pylsl import StreamInfo, StreamOutlet, IRREGULAR_RATE
+from pylsl import StreamInfo, StreamOutlet, IRREGULAR_RATE, local_clock
 from pygame import mixer
 import RPi.GPIO as GPIO
 
-# Setup ZMQ socket
+# Setup ZMQ sockets, the experiment publishes in-process and a proxy thread fans the commands out to the robots
 context = zmq.Context()
+proxy_frontend = context.socket(zmq.XSUB)  # Receives the commands of the experiment
+proxy_frontend.bind("inproc://robot_commands")
+proxy_backend = context.socket(zmq.XPUB)  # Sends the commands to the robots
+proxy_backend.setsockopt(zmq.SNDHWM, 10000)  # Room for a burst of commands per slow subscriber, a full queue drops them for that robot only
+proxy_backend.setsockopt(zmq.IMMEDIATE, 1)  # Only queue messages for completed connections
+proxy_backend.bind("tcp://*:5556")
+threading.Thread(target=zmq.proxy, args=(proxy_frontend, proxy_backend), daemon=True).start()
+
 publisher_socket = context.socket(zmq.PUB)
-publisher_socket.bind("tcp://*:5556")
+publisher_socket.setsockopt(zmq.SNDHWM, 10000)  # Room for a burst of commands before the proxy thread forwards them
+publisher_socket.setsockopt(zmq.LINGER, 100)  # Give the final "all off" 100 ms to leave on close, then drop it
+publisher_socket.connect("inproc://robot_commands")
 
 # Inititialize the LSL streams
 state_streams = {
@@ -21,13 +36,40 @@ state_streams = {
     'user_input':       StreamOutlet(StreamInfo('User_input',       'state', 1, IRREGULAR_RATE, 'int8', 'user_input')),
 }
 
+# Queue of (timestamp, cue, robot, stop, user) samples, pushed to LSL in chunks of lsl_chunk_size by the LSL thread
+lsl_queue = deque(maxlen=8192)
+lsl_period = 0.01  # Sample the state streams at 100 Hz
+lsl_push_interval = 0.1  # Push the queued samples every 100 ms
+lsl_reorder_window = 0.2  # Hold the samples back 200 ms, so button edges queued late are pushed in timestamp order
+lsl_chunk_size = 32
+lsl_chunk_streams = ('cue_state', 'robot_state', 'stop_state', 'user_input')
+lsl_chunk_buffers = {name: np.empty((lsl_chunk_size, 1), dtype=np.int8) for name in lsl_chunk_streams}
+lsl_chunk_timestamps = np.empty(lsl_chunk_size)
+cue_state_buffer = lsl_chunk_buffers['cue_state']
+robot_state_buffer = lsl_chunk_buffers['robot_state']
+stop_state_buffer = lsl_chunk_buffers['stop_state']
+user_input_buffer = lsl_chunk_buffers['user_input']
+lsl_chunk_outlets = [(state_streams[name], lsl_chunk_buffers[name]) for name in lsl_chunk_streams]
+
 # Initialize the haptic vest communication
 haptic_vest = TactileComm(comport='/dev/ttyACM0', baudrate=115200)
 vibration_intensity = 40
 
+# Vest dots that vibrate for a tactile cue
+TACTILE_DOTS = (1, 4, 13, 16, 17, 20, 29, 32)
+
+# Multi-dot call of the vest, sends the dots of a cue as one serial frame in TactileComm versions that provide it
+vest_submit_dots = getattr(haptic_vest, 'submit_dots', None)
+
 # Initialize the audio mixer
 mixer.init(buffer=4096)
 
+# Load the sounds once, decoding a WAV from the SD card delays the cue and the feedback
+SOUNDS = {name: mixer.Sound(name + '.wav') for name in ('sine', 'Short', 'Long', 'Correct', 'Wrong')}
+WHITENOISE = mixer.Sound('whitenoise.wav')
+noise_channel = mixer.Channel(0)
+sound_channel = mixer.Channel(1)
+
 # Initialize the GPIO pins
 buttons = {
     'experiment': 12,
@@ -42,10 +84,42 @@ buttons = {
     'user_long': 4
 }
 
+# Pin numbers used in the loops, bound once to skip the dict lookups
+PIN_TRAINING = buttons['training']
+PIN_AUDIO = buttons['audio']
+PIN_TACTILE = buttons['tactile']
+PIN_START = buttons['start']
+PIN_STOP = buttons['stop']
+PIN_USER_MAIN = buttons['user_main']
+PIN_USER_SHORT = buttons['user_short']
+PIN_USER_LONG = buttons['user_long']
+
 GPIO.setmode(GPIO.BCM)
 for button_pin in buttons.values():
     GPIO.setup(button_pin, GPIO.IN, pull_up_down=GPIO.PUD_DOWN)
 
+# Edge timestamps of the response and stop buttons, filled by the GPIO callback thread
+button_presses = {pin: deque() for pin in (PIN_USER_MAIN, PIN_USER_SHORT, PIN_USER_LONG, PIN_STOP)}
+button_event = threading.Event()
+
+def _on_edge(channel):
+    """
+    Stamp a button edge as soon as the kernel reports it and wake up the experiment loop.
+
+    Args:
+        channel (int): GPIO pin that triggered the edge.
+
+    Returns:
+        None
+    """
+    button_presses[channel].append(time.perf_counter_ns())
+    button_event.set()
+
+# The response buttons close to 3V3, the stop button opens the circuit
+for button_pin in (PIN_USER_MAIN, PIN_USER_SHORT, PIN_USER_LONG):
+    GPIO.add_event_detect(button_pin, GPIO.RISING, callback=_on_edge, bouncetime=5)
+GPIO.add_event_detect(PIN_STOP, GPIO.FALLING, callback=_on_edge, bouncetime=5)
+
 
 # Global experiment parameters
 experiment_params = {
@@ -64,6 +138,123 @@ experiment_params = {
 
 DEBUG = True
 
+# Progress of the running experiment, written by the experiment loop and read by the status printer
+run_status = {
+    'start_time': 0,
+    'robot_stop_time': 0,
+    'robot_stopped': False,
+    'robot_detected': False
+}
+run_finished = threading.Event()  # Stops the sampler and printer threads at the end of a run
+
+rng = np.random.default_rng()  # Random generator for the trial schedule
+
+# Real-time scheduling of the experiment thread, add isolcpus=3 nohz_full=3 rcu_nocbs=3 to /boot/cmdline.txt
+# so the kernel keeps other tasks off the experiment core
+experiment_cpu = 3  # CPU core reserved for the experiment
+experiment_priority = 50  # SCHED_FIFO priority, not above the threaded GPIO interrupt handlers
+
+def set_realtime_priority():
+    """
+    Pin the calling thread to the experiment core and run it with SCHED_FIFO priority. Threads started
+    later inherit both and drop back with set_normal_priority, the LSL and GPIO callback threads started
+    before keep running on the other cores.
+
+    Args:
+        None
+
+    Returns:
+        None
+    """
+    try:
+        os.sched_setaffinity(0, {experiment_cpu})
+        os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(experiment_priority))
+    except (OSError, AttributeError) as error:
+        print(f'Real-time scheduling not available: {error}')
+
+def set_normal_priority():
+    """
+    Move the calling thread back to the default scheduler and off the experiment core, for the helper
+    threads started by the real-time experiment thread.
+
+    Args:
+        None
+
+    Returns:
+        None
+    """
+    try:
+        os.sched_setscheduler(0, os.SCHED_OTHER, os.sched_param(0))
+        os.sched_setaffinity(0, set(range(os.cpu_count())) - {experiment_cpu} or {experiment_cpu})
+    except (OSError, AttributeError) as error:
+        print(f'Default scheduling not available: {error}')
+
+
+def send_command(topic, data):
+    """
+    Publish a robot command without ever blocking the experiment loop.
+
+    The topic and the data are sent as two frames, so the robots dispatch on the topic frame without parsing.
+    The PUB socket never blocks or raises here, a command past the SNDHWM queue limit is dropped silently.
+
+    Args:
+        topic (str or int): Topic of the command, "all", "led" or a robot ID.
+        data (str or int): Data of the command, e.g. "pause" or 1.
+
+    Returns:
+        None
+    """
+    publisher_socket.send_multipart([str(topic).encode(), str(data).encode()], flags=zmq.NOBLOCK)
+
+current_led = None  # LED state last sent to the robots
+
+def set_led(led, force=False):
+    """
+    Send an LED state to the robots, skipping it if the robots already show that state.
+
+    Args:
+        led (int): LED state, 0 off, 1 response window, 2 correct, 3 wrong.
+        force (bool): If True, send the state even if it did not change.
+
+    Returns:
+        None
+    """
+    global current_led
+    if force or led != current_led:
+        send_command("led", led)
+        current_led = led
+
+def precise_sleep(duration, spin=0.002):
+    """
+    Sleep for a duration with sub-millisecond accuracy, the scheduler sleeps until shortly
+    before the deadline and the remainder is busy-waited on perf_counter_ns.
+
+    Args:
+        duration (float): Duration to sleep in seconds.
+        spin (float): Time before the deadline in seconds that is busy-waited.
+
+    Returns:
+        None
+    """
+    perf_counter_ns = time.perf_counter_ns
+    deadline = perf_counter_ns() + int(duration * 1e9)
+    if duration > spin:
+        time.sleep(duration - spin)
+    while perf_counter_ns() < deadline:
+        pass
+
+def close_publisher(linger=0.1):
+    """
+    Close the publisher after giving the proxy thread time to forward the last commands.
+
+    Args:
+        linger (float): Time in seconds the proxy gets to forward the pending commands.
+
+    Returns:
+        None
+    """
+    time.sleep(linger)  # The proxy is a daemon thread, it stops with the interpreter
+    publisher_socket.close()
 
 def generate_trials(num_repeats=0, duration=0, start_offset=30, end_offset=10, cue_types=[0, 1, 2, 3], effect_types=[0, 1, 2, 3, 4, 5, 6], min_interval=8, max_interval=12):
     """
@@ -83,29 +274,43 @@ def generate_trials(num_repeats=0, duration=0, start_offset=30, end_offset=10, c
         list: List of tuples representing the trials with each tuple containing
               (timestamp, cue, effect).
     """
-    trials = []  # Initialize an empty list to hold the generated trials
-
     if num_repeats:
         # Generate all combinations of cues and effects
         combinations = [(cue, effect) for cue in cue_types for effect in effect_types]
-        repeated_combinations = combinations * num_repeats  # Repeat each combination num_rep times
-        random.shuffle(repeated_combinations)  # Shuffle the combinations for randomness
-
-        timestamp = start_offset  # Start timestamp for the first trial
-        for cue, effect in repeated_combinations:
-            trials.append((timestamp, cue, effect))  # Append the trial with its timestamp
-            timestamp += random.randint(min_interval, max_interval)  # Update the timestamp for the next trial
+        repeated_combinations = np.array(combinations * num_repeats).reshape(-1, 2)  # Repeat each combination num_rep times
+        rng.shuffle(repeated_combinations)  # Shuffle the combinations for randomness
+        cues = repeated_combinations[:, 0]
+        effects = repeated_combinations[:, 1]
 
     else:
         # If no repetitions are specified, calculate the number of trials based on duration
-        num_repeats = int((duration - start_offset - end_offset) / ((max_interval + min_interval) / 2))
-        timestamp = start_offset  # Start timestamp for the first trial
-        for _ in range(num_repeats):
-            trials.append((timestamp, cue_types[0], 1))  # Default to the first cue type
-            timestamp += random.randint(min_interval, max_interval)  # Update the timestamp for the next trial
+        num_repeats = max(int((duration - start_offset - end_offset) / ((max_interval + min_interval) / 2)), 0)
+        cues = np.full(num_repeats, cue_types[0])  # Default to the first cue type
+        effects = np.ones(num_repeats, dtype=int)
+
+    # Draw all random intervals at once and accumulate them into the trial timestamps
+    intervals = rng.integers(min_interval, max_interval + 1, size=len(cues))
+    timestamps = start_offset + np.cumsum(intervals) - intervals  # The first trial starts at start_offset
+    trials = list(zip(timestamps.tolist(), cues.tolist(), effects.tolist()))
 
     return trials
 
+def play_tactile_cue():
+    """
+    Vibrate the dots of the tactile cue, in one call to the vest when TactileComm supports it.
+
+    Args:
+        None
+
+    Returns:
+        None
+    """
+    if vest_submit_dots is not None:
+        vest_submit_dots(TACTILE_DOTS, 10, vibration_intensity)  # One serial frame for all dots
+    else:
+        for dot in TACTILE_DOTS:
+            haptic_vest.submit_dot(dot, 10, vibration_intensity)
+
 def handle_trial(trial, stop_robot=False):
     """
     Handle a single trial by setting the cue and stop states based on the trial configuration.
@@ -117,39 +322,50 @@ def handle_trial(trial, stop_robot=False):
         None
     """
     global experiment_params
-    experiment_params['stop_state'] = trial[2] + 1
-    stop_duration = 0.2 + 0.1 * trial[2]  # Calculate stop duration based on effect
-
-    cue = trial[1]
-    if cue == 0:
-        print(f"\n\nNo Cue, Stop duration: {stop_duration:.1f}s")
-        experiment_params['cue_state'] = 1
-    elif cue == 1:
-        print(f"\n\nAudio Cue, Stop duration: {stop_duration:.1f}s")
-        mixer.Channel(1).play(mixer.Sound('sine.wav'))
-        experiment_params['cue_state'] = 2
-    elif cue == 2:
-        print(f"\n\nTactile Cue, Stop duration: {stop_duration:.1f}s")
-        for dot in [1, 4, 13, 16, 17, 20, 29, 32]:
-            haptic_vest.submit_dot(dot, 10, vibration_intensity)
-        experiment_params['cue_state'] = 3
-    elif cue == 3:
-        print(f"\n\nAudio and Tactile Cue, Stop duration: {stop_duration:.1f}s")
-        mixer.Channel(1).play(mixer.Sound('sine.wav'))
-        for dot in [1, 4, 13, 16, 17, 20, 29, 32]:
-            haptic_vest.submit_dot(dot, 10, vibration_intensity)
-        experiment_params['cue_state'] = 4
+    CUE_HANDLERS[(trial[1], trial[2])]()
 
     # Stop the robot if required
     if stop_robot:
         if experiment_params['robot_stop_id'] == -1:
             experiment_params['robot_stop_id'] = random.randint(0, experiment_params['num_robots'] - 1)
         
-        publisher_socket.send_string(f"{experiment_params['robot_stop_id']} pause")
+        send_command(experiment_params['robot_stop_id'], "pause")
         state_streams['robot_id'].push_sample([experiment_params['robot_stop_id'] + 1])
         print(f"Stop Robot: {experiment_params['robot_stop_id']}")
         experiment_params['robot_state'] = 1
 
+def build_cue_handler(cue, effect):
+    """
+    Build the cue presentation of one cue and effect combination with all its constants precomputed.
+
+    Args:
+        cue (int): Cue type, 0 none, 1 audio, 2 tactile, 3 audio and tactile.
+        effect (int): Effect type, sets the stop duration.
+
+    Returns:
+        function: Presents the cue and sets the cue and stop states.
+    """
+    stop_state = effect + 1
+    cue_state = cue + 1
+    sound = SOUNDS['sine'] if cue in (1, 3) else None
+    tactile = cue in (2, 3)
+    label = ('No Cue', 'Audio Cue', 'Tactile Cue', 'Audio and Tactile Cue')[cue]
+    message = f"\n\n{label}, Stop duration: {0.2 + 0.1 * effect:.1f}s"
+
+    def present_cue():
+        if sound:
+            sound_channel.play(sound)
+        if tactile:
+            play_tactile_cue()
+        experiment_params['stop_state'] = stop_state
+        experiment_params['cue_state'] = cue_state
+        print(message)
+
+    return present_cue
+
+# Cue presentation of every cue and effect combination, looked up by (cue, effect) in handle_trial
+CUE_HANDLERS = {(cue, effect): build_cue_handler(cue, effect) for cue in range(4) for effect in range(7)}
+
 def end_pause():
     """
     End the current pause and reset the states to default.
@@ -162,16 +378,29 @@ def end_pause():
     """
     global experiment_params
     if experiment_params['robot_stop_id'] != -1:
-        publisher_socket.send_string(f"{experiment_params['robot_stop_id']} go")
+        send_command(experiment_params['robot_stop_id'], "go")
         print(f"\nResume Robot: {experiment_params['robot_stop_id']}")
     
     experiment_params['robot_state'] = 0
     experiment_params['cue_state'] = 0
     experiment_params['stop_state'] = 0
 
+def read_user_input():
+    """
+    Read the levels of the response buttons from the memory-mapped GPIO registers, without a system call.
+
+    Args:
+        None
+
+    Returns:
+        int: Bitmask of the pressed buttons, bit 0 main, bit 1 short, bit 2 long.
+    """
+    # Shift each level into its bit instead of branching on the button states
+    return GPIO.input(PIN_USER_MAIN) | (GPIO.input(PIN_USER_SHORT) << 1) | (GPIO.input(PIN_USER_LONG) << 2)
+
 def push_lsl_streams():
     """
-    Push the current state of the experiment to the LSL streams.
+    Queue the current state of the experiment for the LSL streams.
 
     Args:
         None
@@ -179,17 +408,136 @@ def push_lsl_streams():
     Returns:
         None
     """
-    global state_streams, experiment_params
-    state_streams['cue_state'].push_sample([experiment_params['cue_state']])
-    state_streams['robot_state'].push_sample([experiment_params['robot_state']])
-    state_streams['stop_state'].push_sample([experiment_params['stop_state']])
+    user_input = read_user_input()
+    lsl_queue.append((local_clock(), experiment_params['cue_state'], experiment_params['robot_state'], experiment_params['stop_state'], user_input))
 
-    user_input = 0
-    if GPIO.input(buttons['user_main']): user_input |= (1 << 0)
-    if GPIO.input(buttons['user_short']): user_input |= (1 << 1)
-    if GPIO.input(buttons['user_long']): user_input |= (1 << 2)
-    
-    state_streams['user_input'].push_sample([user_input])
+def push_user_event(user_input, edge_ns):
+    """
+    Queue the current state of the experiment with a button edge for the LSL streams.
+
+    Args:
+        user_input (int): Bitmask of the pressed buttons.
+        edge_ns (int): perf_counter_ns timestamp of the edge, perf_counter and local_clock share CLOCK_MONOTONIC.
+
+    Returns:
+        None
+
+    The sample is queued after periodic samples with later timestamps, stream_lsl_samples puts it back in order.
+    """
+    lsl_queue.append((edge_ns / 1e9, experiment_params['cue_state'], experiment_params['robot_state'], experiment_params['stop_state'], user_input))
+
+def stream_lsl_samples():
+    """
+    Drain the queued samples into the LSL outlets, one chunk per stream (runs on its own thread).
+
+    Samples are pushed in timestamp order once they are older than lsl_reorder_window. A button edge picked
+    up even later is pushed with the timestamp of the sample before it, so the outlets never go back in time.
+
+    Args:
+        None
+
+    Returns:
+        None
+    """
+    pending = []  # Samples waiting for the reorder window, a heap ordered by timestamp
+    last_timestamp = 0.0  # Timestamp of the last pushed sample
+    while True:
+        while lsl_queue:
+            heapq.heappush(pending, lsl_queue.popleft())
+
+        ready_time = local_clock() - lsl_reorder_window
+        count = 0
+        while pending and pending[0][0] <= ready_time and count < lsl_chunk_size:
+            timestamp, cue, robot, stop, user = heapq.heappop(pending)
+            last_timestamp = max(timestamp, last_timestamp)
+            lsl_chunk_timestamps[count] = last_timestamp
+            cue_state_buffer[count, 0] = cue
+            robot_state_buffer[count, 0] = robot
+            stop_state_buffer[count, 0] = stop
+            user_input_buffer[count, 0] = user
+            count += 1
+
+        if count:
+            timestamps = lsl_chunk_timestamps[:count].tolist()
+            for outlet, buffer in lsl_chunk_outlets:
+                outlet.push_chunk(buffer[:count], timestamps)
+        if count < lsl_chunk_size:
+            time.sleep(lsl_push_interval)  # Let the samples of the next chunk accumulate
+
+# Push the LSL samples from a separate thread so the outlets never delay the experiment timing
+threading.Thread(target=stream_lsl_samples, daemon=True).start()
+
+def sample_lsl_streams():
+    """
+    Sample the experiment state into the LSL queue every lsl_period until the run is finished.
+
+    Args:
+        None
+
+    Returns:
+        None
+    """
+    set_normal_priority()
+    monotonic = time.monotonic
+    next_time = monotonic()
+    while True:
+        push_lsl_streams()
+        next_time += lsl_period
+        delay = next_time - monotonic()
+        if delay < 0:
+            next_time -= delay  # Fell behind, restart the cadence from now instead of catching up
+            delay = 0
+        if run_finished.wait(delay):
+            break
+
+def print_status():
+    """
+    Print the experiment state and time once per second until the run is finished.
+
+    Args:
+        None
+
+    Returns:
+        None
+    """
+    set_normal_priority()
+    while not run_finished.wait(1):
+        now = time.monotonic()
+
+        # Clear the line
+        sys.stdout.write("\033[K")
+        if run_status['robot_stopped']:
+            print("\rWaiting for detection. Elapsed: ", int(now-run_status['robot_stop_time']),"\t", end="")
+        elif run_status['robot_detected']:
+            print("\rResponse Window. Elapsed: ", int(now-run_status['robot_stop_time']),"\t", end="")
+        else:
+            print("\rElapsed ", int(now-run_status['start_time']),"\t", end="")
+
+def pop_press(button_pin):
+    """
+    Take the oldest pending edge of a button.
+
+    Args:
+        button_pin (int): GPIO pin of the button.
+
+    Returns:
+        int: perf_counter_ns timestamp of the edge, or 0 if there was none.
+    """
+    presses = button_presses[button_pin]
+    return presses.popleft() if presses else 0
+
+def clear_presses(*button_pins):
+    """
+    Discard edges that happened before the current phase of the trial.
+
+    Args:
+        button_pins (int): GPIO pins of the buttons.
+
+    Returns:
+        None
+    """
+    for button_pin in button_pins:
+        button_presses[button_pin].clear()
         
 def reset_robots():
     """
@@ -201,9 +549,9 @@ def reset_robots():
     Returns:
         None
     """
-    publisher_socket.send_string("all off")
+    send_command("all", "off")
     time.sleep(0.5)
-    publisher_socket.send_string("led 0")
+    set_led(0, force=True)  # Robots may have restarted in between, always resend
 
 
 
@@ -234,11 +582,12 @@ def run_training(is_training=False, is_test=False, num_repeats=0, cue_types=[0],
     reset_robots()
 
     # start the white noise
-    mixer.Channel(0).play(mixer.Sound('whitenoise.wav'), -1)
+    noise_channel.play(WHITENOISE, -1)
 
     # reset the state variables 
     experiment_params['cue_state'] = 0
     experiment_params['robot_state'] = 0
+    clear_presses(PIN_USER_MAIN, PIN_USER_SHORT, PIN_USER_LONG, PIN_STOP)
 
 
     # initianilze the experiment parameters
@@ -248,22 +597,22 @@ def run_training(is_training=False, is_test=False, num_repeats=0, cue_types=[0],
     trial_finished = False
     in_trial = False
 
-    # initialize print helpers
-    last_print_time = 0
-
-    # initialize the experiment clock
-    start_time = time.time()
+    # initialize the experiment clock, monotonic never jumps on NTP adjustments
+    monotonic = time.monotonic
+    perf_counter_ns = time.perf_counter_ns
+    start_time = monotonic()
     elapsed_time = 0
     robot_stop_time = 0
-    lsl_update_time = 0
+    robot_stop_ns = 0
+    run_status.update(start_time=start_time, robot_stopped=False, robot_detected=False)
 
     # select a random robot for the training and start it
     if is_training or is_test:
         experiment_params['robot_stop_id'] = random.randint(0, experiment_params['num_robots']-1)     
-        publisher_socket.send_string("%s on" % str(experiment_params['robot_stop_id']))
+        send_command(experiment_params['robot_stop_id'], "on")
     else:
         experiment_params['robot_stop_id'] = -1
-        publisher_socket.send_string("all on")
+        send_command("all", "on")
 
     if is_training:
         print('Training started.\n')
@@ -272,40 +621,41 @@ def run_training(is_training=False, is_test=False, num_repeats=0, cue_types=[0],
     else:
         print('Experiment started.\n')
 
+    # Sample the LSL streams and print the progress on their own cadences
+    run_finished.clear()
+    threads = [threading.Thread(target=sample_lsl_streams, daemon=True), threading.Thread(target=print_status, daemon=True)]
+    for thread in threads:
+        thread.start()
+
     # Main training loop
     while elapsed_time <= total_duration:
+        now = monotonic()
 
         # Upddate the elapsed time
         if not in_trial:
-            elapsed_time = (time.time() - start_time)
-
-        # Print the experiment state and time 1 time per second
-        if time.time() - last_print_time > 1:
-            last_print_time = time.time()
-            
-            # Clear the line
-            sys.stdout.write("\033[K")
-            if robot_stopped:  
-                print("\rWaiting for detection. Elapsed: ", int(time.time()-robot_stop_time),"\t", end="")
-            elif robot_detected:
-                print("\rResponse Window. Elapsed: ", int(time.time()-robot_stop_time),"\t", end="")
-            else:
-                print("\rElapsed ", int(elapsed_time),"\t", end="")
+            elapsed_time = (now - start_time)
 
         # Check if the current trial is up and handle it
         if trial_index < len(trials) and not robot_stopped and elapsed_time >= trials[trial_index][0] and not in_trial:
             handle_trial(trials[trial_index], stop_robot=True)
             robot_stopped = True
-            robot_stop_time = time.time()
+            robot_stop_time = now
+            robot_stop_ns = perf_counter_ns()
             in_trial = True
+            clear_presses(PIN_USER_MAIN)
+            run_status.update(robot_stop_time=robot_stop_time, robot_stopped=True)
 
         # Check if the stopped robot has been detected 
-        if trial_index < len(trials) and robot_stopped and GPIO.input(buttons['user_main']):
+        detection_ns = pop_press(PIN_USER_MAIN) if robot_stopped else 0
+        if trial_index < len(trials) and detection_ns:
+            # Push the detection with the time of the edge
+            push_user_event(1 << 0, detection_ns)
+            print("\nDetected after %.3f s" % ((detection_ns - robot_stop_ns) / 1e9))
             
             if is_training:
                 # Give the user feedback on the bisected period
-                if trials[trial_index][2] == 0: mixer.Channel(1).play(mixer.Sound('Short.wav'))
-                elif trials[trial_index][2] == 6: mixer.Channel(1).play(mixer.Sound('Long.wav'))
+                if trials[trial_index][2] == 0: sound_channel.play(SOUNDS['Short'])
+                elif trials[trial_index][2] == 6: sound_channel.play(SOUNDS['Long'])
 
                 # No response needed in training
                 trial_finished = True
@@ -315,7 +665,7 @@ def run_training(is_training=False, is_test=False, num_repeats=0, cue_types=[0],
 
 
             # Add the temporal bisection period and restart the robot
-            time.sleep(0.2 + 0.1 * trials[trial_index][2])
+            precise_sleep(0.2 + 0.1 * trials[trial_index][2])
             
             # Restart the robot
             end_pause()
@@ -326,40 +676,47 @@ def run_training(is_training=False, is_test=False, num_repeats=0, cue_types=[0],
 
             # Turn on the led if it is not a training trial
             if not is_training:
-                publisher_socket.send_string("led 1")  
+                set_led(1)  
 
             # MOve on to the response window
             robot_stopped = False
+            clear_presses(PIN_USER_SHORT, PIN_USER_LONG)
+            run_status.update(robot_stopped=False, robot_detected=robot_detected)
+            now = monotonic()
 
         # Wait for the user respnse
-        if trial_index < len(trials) and robot_detected and (GPIO.input(buttons['user_long']) == 1 or GPIO.input(buttons['user_short']) == 1):
-            print("\nUser input detected", GPIO.input(buttons['user_long']), GPIO.input(buttons['user_short']))
+        long_ns = pop_press(PIN_USER_LONG) if robot_detected else 0
+        short_ns = pop_press(PIN_USER_SHORT) if robot_detected else 0
+        if trial_index < len(trials) and (long_ns or short_ns):
+            print("\nUser input detected", int(bool(long_ns)), int(bool(short_ns)))
+            push_user_event((bool(short_ns) << 1) | (bool(long_ns) << 2), max(long_ns, short_ns))
             
             # Provide feedback 
-            if GPIO.input(buttons['user_long']) == 1: 
+            if long_ns: 
                 if trials[trial_index][2]  == 0:
                     print("wrong, short and not long")
-                    mixer.Channel(1).play(mixer.Sound('Wrong.wav'))
-                    publisher_socket.send_string("led 3")  
+                    sound_channel.play(SOUNDS['Wrong'])
+                    set_led(3)  
                 elif trials[trial_index][2]  == 6:
                     print("correct, long")
-                    mixer.Channel(1).play(mixer.Sound('Correct.wav'))
-                    publisher_socket.send_string("led 2")  
+                    sound_channel.play(SOUNDS['Correct'])
+                    set_led(2)  
 
             # Provide feedback
-            if GPIO.input(buttons['user_short']) == 1: 
+            if short_ns: 
                 if trials[trial_index][2]  == 0:
                     print("correct, short ")
-                    mixer.Channel(1).play(mixer.Sound('Correct.wav'))
-                    publisher_socket.send_string("led 2")  
+                    sound_channel.play(SOUNDS['Correct'])
+                    set_led(2)  
                 elif trials[trial_index][2]  == 6:
                     print("wrong, long and not short")
-                    mixer.Channel(1).play(mixer.Sound('Wrong.wav'))
-                    publisher_socket.send_string("led 3")  
+                    sound_channel.play(SOUNDS['Wrong'])
+                    set_led(3)  
 
             # Move to the next trial
             robot_detected = False
             trial_finished = True
+            run_status['robot_detected'] = False
         
         # The trial is finished update the state variables and move on
         if trial_finished:
@@ -368,26 +725,33 @@ def run_training(is_training=False, is_test=False, num_repeats=0, cue_types=[0],
             in_trial = False
 
             # Turn off the led
-            publisher_socket.send_string("led 0")  
+            set_led(0)  
 
             # Move to the next trial
             trial_index += 1
 
             # Account for the time taken to respond
-            start_time += time.time() - robot_stop_time
+            start_time += now - robot_stop_time
+            run_status['start_time'] = start_time
 
             # Add a blank line for better readability
             print('\n')
 
-        # Update the LSL streams at 100 Hz
-        if time.time() - lsl_update_time >= 0.01:
-            push_lsl_streams()  
-            lsl_update_time = time.time()
-
         # Check for preleminary experiment stop 
-        if GPIO.input(buttons['stop']) != 1:
+        if pop_press(PIN_STOP):
             break
 
+        # Sleep until a button edge arrives, or until the next trial or the end of the run is due
+        if in_trial:
+            timeout = None
+        else:
+            timeout = max(start_time + (trials[trial_index][0] if trial_index < len(trials) else total_duration) - now, 0)
+        if button_event.wait(timeout):
+            button_event.clear()
+
+    run_finished.set()
+    for thread in threads:
+        thread.join()
     print('\nExperiment ended after %s seconds.\n' % str(elapsed_time))
     reset_robots()
 
@@ -404,32 +768,36 @@ def main():
     Returns:
         None
     """
+    set_realtime_priority()
     try:
         lsl_update_time = 0
         while True:
 
-            if time.time() - lsl_update_time >= 0.01:
-                state_streams['cue_state'].push_sample([-1])
-                state_streams['robot_state'].push_sample([-1])
-                state_streams['stop_state'].push_sample([-1])
-                state_streams['user_input'].push_sample([-1])
-                lsl_update_time = time.time()
+            now = time.monotonic()
+            if now - lsl_update_time >= lsl_period:
+                lsl_queue.append((local_clock(), -1, -1, -1, -1))
+                lsl_update_time = now
 
-            mixer.Channel(0).pause()
-            if GPIO.input(buttons['start']) != 1 and GPIO.input(buttons['training']) == 1:
+            noise_channel.pause()
+            if GPIO.input(PIN_START) != 1 and GPIO.input(PIN_TRAINING) == 1:
                 run_training(is_training=True, num_repeats=7, cue_types=[0], effect_types=[0, 6])
-            elif GPIO.input(buttons['start']) != 1 and GPIO.input(buttons['audio']) == 1:
+            elif GPIO.input(PIN_START) != 1 and GPIO.input(PIN_AUDIO) == 1:
                 run_training(is_test=True, num_repeats=7, cue_types=[0], effect_types=[0, 6])
-            elif GPIO.input(buttons['start']) != 1 and GPIO.input(buttons['tactile']) == 1:
+            elif GPIO.input(PIN_START) != 1 and GPIO.input(PIN_TACTILE) == 1:
                 run_training(num_repeats=13, cue_types=[0, 2])
 
-            if GPIO.input(buttons['stop']) != 1:
-                publisher_socket.send_string("all off")
+            if GPIO.input(PIN_STOP) != 1:
+                send_command("all", "off")
+                close_publisher()
                 break
 
+            # Block until the next LSL tick instead of spinning at real-time priority, a button edge ends the wait early
+            if button_event.wait(max(lsl_update_time + lsl_period - time.monotonic(), 0)):
+                button_event.clear()
+
     except KeyboardInterrupt:
-        publisher_socket.send_string("all off")
-        publisher_socket.close()
+        send_command("all", "off")
+        close_publisher()
 
 if __name__ == '__main__':
     main()
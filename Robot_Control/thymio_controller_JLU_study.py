@@ -1,10 +1,45 @@
 # Import required packages for robot control and communication
 import argparse
+import os
 import time
 import random
 import zmq
 from thymiodirect import Connection, Thymio
 
+# Robot commands arrive as two bytes: (robot id, opcode), robot id 255 addresses all robots
+ALL_ROBOTS = 255
+OP_PAUSE = 1  # Pause a single robot
+OP_GO = 2  # Resume a single robot
+OP_ALL_ON = 3  # Start all robots
+OP_ALL_OFF = 4  # Stop all robots
+STATES = {OP_ALL_ON: 'on', OP_ALL_OFF: 'off'}  # Robot state for each opcode sent to all robots
+ACTIONS = {OP_PAUSE: 'pause', OP_GO: 'go'}  # Robot action for each opcode sent to a single robot
+
+# Left and right motor targets of each action for a given speed and rotation direction
+ACTION_MOTORS = {
+    'go': lambda speed, direction: (speed, speed),  # Move forward at set speed
+    'avoid': lambda speed, direction: (direction * speed, -direction * speed),  # Rotate to avoid an obstacle
+    'back': lambda speed, direction: (-speed, -speed),  # Move backward at set speed
+    'stop': lambda speed, direction: (0, 0),  # Stop all motors
+    'pause': lambda speed, direction: (0, 0),  # Stop all motors while paused
+}
+
+# Real-time scheduling of the controller, core 3 is reserved for the experiment controller
+controller_cpu = 2  # CPU core of the Thymio controller
+controller_priority = 40  # SCHED_FIFO priority, below the experiment controller
+
+def set_realtime_priority():
+    """
+    Pin the controller to its core and run it with SCHED_FIFO priority.
+
+    Keeps running with the default scheduler if the settings are not permitted (e.g. not run as root).
+    """
+    try:
+        os.sched_setaffinity(0, {controller_cpu})
+        os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(controller_priority))
+    except (OSError, AttributeError) as error:
+        print(f'Real-time scheduling not available: {error}')
+
 def detect_obstacle(prox_values, threshold=1000):
     """
     Check if there is an obstacle based on proximity sensor values.
@@ -16,11 +51,8 @@ def detect_obstacle(prox_values, threshold=1000):
     Returns:
     - bool: True if an obstacle is detected, otherwise False.
     """
-    # Iterate through proximity sensor values and check if any exceed the threshold
-    for value in prox_values:
-        if value > threshold:
-            return True  # Obstacle detected
-    return False  # No obstacle detected
+    # Compare the highest proximity sensor value against the threshold in a single builtin call
+    return max(prox_values) > threshold
 
 def detect_line(prox_values, threshold=300):
     """
@@ -33,12 +65,8 @@ def detect_line(prox_values, threshold=300):
     Returns:
     - int: 1 if a line is detected on the left, 2 if on the right, 0 if none.
     """
-    # Check left and right ground sensor values to detect a line
-    if prox_values[0] < threshold:
-        return 1  # Line detected on the left side
-    elif prox_values[1] < threshold:
-        return 2  # Line detected on the right side
-    return 0  # No line detected
+    # Check the left ground sensor first, then the right one, 0 if neither sees a line
+    return 1 if prox_values[0] < threshold else (2 if prox_values[1] < threshold else 0)
 
 def main(robot_id='0', ip='localhost', port=5556):
     """
@@ -49,6 +77,7 @@ def main(robot_id='0', ip='localhost', port=5556):
     - ip (str): IP address for the ZMQ socket.
     - port (int): Port number for the ZMQ socket.
     """
+    set_realtime_priority()  # Before connecting, so the thymiodirect thread inherits the settings
     try:
         # Initialize and connect to the Thymio robot
         thymio_handler = Thymio(
@@ -58,14 +87,26 @@ def main(robot_id='0', ip='localhost', port=5556):
         thymio_handler.connect()  # Establish connection to the robot
         robot = thymio_handler.first_node()  # Get the first connected Thymio robot
 
-        # Create a ZMQ context and subscriber socket for communication
+        # Create a ZMQ context and one subscriber socket per topic for communication
         context = zmq.Context()  # Create a ZMQ context for messaging
-        zmq_socket = context.socket(zmq.SUB)  # Create a subscriber socket
-        zmq_socket.connect(f'tcp://{ip}:{port}')  # Connect to the specified IP and port
+        state_socket = context.socket(zmq.SUB)  # Subscriber for the on/off state of all robots
+        state_socket.setsockopt(zmq.CONFLATE, 1)  # Only the latest state matters, drop older queued ones
+        action_socket = context.socket(zmq.SUB)  # Subscriber for the pause/go actions of this robot
+        action_socket.setsockopt(zmq.RCVHWM, 1000)  # Queue every action, none of them may be dropped
+        endpoint = 'ipc:///tmp/robot_control.sock' if ip in ('localhost', '127.0.0.1') else f'tcp://{ip}:{port}'  # Use the local socket to skip the TCP stack
+        state_socket.connect(endpoint)
+        action_socket.connect(endpoint)
         
         # Subscribe to specific topics for receiving messages
-        zmq_socket.setsockopt_string(zmq.SUBSCRIBE, 'all')  # Subscribe to messages for all robots
-        zmq_socket.setsockopt_string(zmq.SUBSCRIBE, robot_id)  # Subscribe to messages for this specific robot
+        robot_target = int(robot_id)  # Robot id as sent in the first byte of a command
+        state_socket.setsockopt(zmq.SUBSCRIBE, bytes([ALL_ROBOTS]))  # Subscribe to messages for all robots
+        action_socket.setsockopt(zmq.SUBSCRIBE, bytes([robot_target]))  # Subscribe to messages for this specific robot
+
+        # Block for at most one 100 Hz control tick while no message is pending
+        poller = zmq.Poller()
+        poller.register(state_socket, zmq.POLLIN)
+        poller.register(action_socket, zmq.POLLIN)
+        poll_timeout = 10  # Poll timeout in milliseconds
 
         # Robot configuration and control variables
         robot_speed = 250             # Maximum speed of the robot in units
@@ -76,22 +117,18 @@ def main(robot_id='0', ip='localhost', port=5556):
 
         robot_action = 'stop'         # Initial action state of the robot
         robot_state = 'off'           # Initial state of the robot (off)
+        motor_targets = None          # Motor targets last sent to the robot
 
         while True:
-            # Receive and process data from the ZMQ socket
-            try:
-                topic, data = zmq_socket.recv(flags=zmq.NOBLOCK).decode('utf-8').split()
-                
-                # Process messages for different topics
-                if topic == 'all':  # If message is for all robots
-                    robot_state = data  # Update robot state based on received data
-                elif topic == robot_id:  # If message is for this specific robot
-                    robot_action = data  # Update action based on received message
-                    print(f'Action: {robot_action}, ID: {robot_id}')  # Debugging output
-
-            except zmq.Again:
-                # No message available; continue to the next loop iteration
-                pass
+            # Wait for data from the ZMQ sockets, fall through to the robot logic on timeout
+            events = dict(poller.poll(poll_timeout))
+
+            # Process messages for different topics
+            if state_socket in events:  # If message is for all robots
+                robot_state = STATES[state_socket.recv()[1]]  # Byte 0 is the topic matched by the subscription, byte 1 the opcode
+            if action_socket in events:  # If message is for this specific robot
+                robot_action = ACTIONS[action_socket.recv()[1]]  # Update action based on received message
+                print(f'Action: {robot_action}, ID: {robot_id}')  # Debugging output
 
             # Handle the robot's state and determine actions
             if robot_state == 'off':
@@ -140,23 +177,11 @@ def main(robot_id='0', ip='localhost', port=5556):
                         robot_action = 'go'
                         action_duration = 0
 
-            # Execute the robot's current action based on the state
-            if robot_action == 'go':
-                # Move forward at set speed
-                robot['motor.left.target'] = robot_speed
-                robot['motor.right.target'] = robot_speed
-            elif robot_action == 'avoid':
-                # Rotate in the opposite direction to avoid obstacle
-                robot['motor.left.target'] = rotation_direction * robot_speed
-                robot['motor.right.target'] = -rotation_direction * robot_speed
-            elif robot_action == 'back':
-                # Move backward at set speed
-                robot['motor.left.target'] = -robot_speed
-                robot['motor.right.target'] = -robot_speed
-            elif robot_action in ('stop', 'pause'):
-                # Stop all motors when stopping or pausing
-                robot['motor.left.target'] = 0
-                robot['motor.right.target'] = 0
+            # Execute the robot's current action, only send the motor targets to the robot when they change
+            targets = ACTION_MOTORS[robot_action](robot_speed, rotation_direction)
+            if targets != motor_targets:
+                motor_targets = targets
+                robot['motor.left.target'], robot['motor.right.target'] = targets
 
     except Exception as error:
         # Handle unexpected errors by stopping the robot
@@ -175,7 +200,7 @@ if __name__ == '__main__':
     
     # Define command-line arguments for robot ID, IP, and port
     parser.add_argument('-d', '--id', help='Set the robot ID for ZMQ communication (default: 0)', default='0')
-    parser.add_argument('-i', '--ip', help='Set the TCP host IP for ZMQ communication (default: localhost)', default='localhost')
+    parser.add_argument('-i', '--ip', help='Set the TCP host IP for ZMQ communication, localhost uses the IPC socket (default: localhost)', default='localhost')
     parser.add_argument('-p', '--port', help='Set the TCP port for ZMQ communication (default: 5556)', default=5556, type=int)
 
     # Parse arguments and pass them to the main function
@@ -1,30 +1,105 @@
 # Import required packages
 import argparse
+import math
+import os
 import time
-import random
+import multiprocessing
+from multiprocessing import shared_memory
 import zmq
+import numpy as np
+from numba import njit
 from thymiodirect import Connection, Thymio
 
+# LED colors, kept as lists because thymiodirect only writes a list as an array variable
+LED_WHITE = [32, 32, 32]
+LED_GREEN = [0, 32, 0]
+LED_RED = [32, 0, 0]
+LED_BLUE = [0, 0, 32]
+LED_OFF = [0, 0, 0]
+LED_CIRCLE_ON = [32] * 8
+LED_CIRCLE_OFF = [0] * 8
+
+# Top and bottom color and circle pattern of each LED message, None keeps the circle as it is
+LED_TABLE = {
+    '1': (LED_WHITE, LED_CIRCLE_ON),  # Bright white, response window
+    '2': (LED_GREEN, None),  # Green, correct response
+    '3': (LED_RED, None),  # Red, wrong response
+    '4': (LED_BLUE, None),  # Blue
+}
+LED_ALL_OFF = (LED_OFF, LED_CIRCLE_OFF)  # Any other message turns off all LEDs
+
+# Robot states and actions, the state machine runs on their codes
+OFF, ON = 0, 1
+STOP, GO, PAUSE, AVOID, BACK = 0, 1, 2, 3, 4
+STATES = ('off', 'on')  # Robot states by code
+ACTIONS = ('stop', 'go', 'pause', 'avoid', 'back')  # Robot actions by code
+
+# Left and right motor targets of each action for a given speed and rotation direction
+ACTION_MOTORS = {
+    GO: lambda speed, direction: (speed, speed),  # Move forward at set speed
+    AVOID: lambda speed, direction: (direction * speed, -direction * speed),  # Rotate to avoid an obstacle
+    BACK: lambda speed, direction: (-speed, -speed),  # Move backward at set speed
+    STOP: lambda speed, direction: (0, 0),  # Stop all motors
+    PAUSE: lambda speed, direction: (0, 0),  # Stop all motors while paused
+}
+
+# Event bits of one frame of the state machine
+OBSTACLE_FRONT = 1 << 0  # Obstacle in front while going
+LINE_LEFT = 1 << 1  # Line under the left ground sensor while going
+LINE_RIGHT = 1 << 2  # Line under the right ground sensor while going
+OBSTACLE_BACK = 1 << 3  # Obstacle behind while backing up
+TIMER_EXPIRED = 1 << 4  # Time limit of the current action exceeded
+LINE_EVENTS = (0, LINE_LEFT, LINE_RIGHT)  # Event bits by detect_line result
+
+# Timer and rotation of a transition
+TIMER_KEEP, TIMER_NONE, TIMER_AVOID, TIMER_BACK = 0, 1, 2, 3  # Keep or clear the timer, or start an avoidance or back timer
+ROTATE_KEEP, ROTATE_LEFT, ROTATE_RIGHT, ROTATE_RANDOM = 0, 1, -1, 2  # Rotation direction after the transition
+
+# Commands shared between the comms and the control process, one uint32 word per command slot
+# Each word holds the command code in the low byte and a sequence number counting the writes above it,
+# a single aligned word is written atomically, so the control process never reads a torn command
+COMMAND_STATE = 0  # Slot of the robot state
+COMMAND_ACTION = 1  # Slot of the robot action
+COMMAND_LED = 2  # Slot of the LED pattern
+COMMAND_SLOTS = 3
+
+# Codes of the raw message data, so the comms process dispatches without decoding
+STATE_CODES = {state.encode(): code for code, state in enumerate(STATES)}
+ACTION_CODES = {action.encode(): code for code, action in enumerate(ACTIONS)}
+LED_CODES = {message.encode(): code for code, message in enumerate(LED_TABLE, start=1)}  # Code 0 turns off all LEDs
+LED_PATTERNS = (LED_ALL_OFF, *LED_TABLE.values())  # LED patterns by code
+
+# Topic frames of the commands
+TOPIC_ALL = b'all'  # Messages for all robots
+TOPIC_LED = b'led'  # LED control messages
+
+# CPU cores of the two processes, core 3 is reserved for the experiment controller
+comms_cpu = 1  # CPU core of the comms process
+comms_nice = -10  # Niceness of the comms process, so a command wakes it ahead of other work on its core
+control_cpu = 2  # CPU core of the control process
+
+@njit(cache=True)
 def detect_obstacle(prox_values, threshold=1000):
     """
     Check if there is an obstacle based on proximity sensor values.
 
     Args:
-    - prox_values (list): List of proximity sensor values.
+    - prox_values (np.ndarray): Array of proximity sensor values.
     - threshold (int): Threshold value to determine if an obstacle is detected.
 
     Returns:
     - bool: True if an obstacle is detected, otherwise False.
     """
-    # Return True if any proximity value exceeds the threshold, indicating an obstacle
-    return any(value > threshold for value in prox_values)
+    # Compare the highest proximity value against the threshold, a branch-free reduction without a temporary array
+    return prox_values.max() > threshold
 
+@njit(cache=True)
 def detect_line(prox_values, threshold=300):
     """
     Detect if there is a line under the robot based on ground sensor values.
 
     Args:
-    - prox_values (list): List of ground sensor values.
+    - prox_values (np.ndarray): Array of ground sensor values.
     - threshold (int): Threshold value to detect a line.
 
     Returns:
@@ -37,15 +112,325 @@ def detect_line(prox_values, threshold=300):
         return 2  # Line detected on the right side
     return 0  # No line detected
 
+def transition(state, action, events):
+    """
+    Find the transition of the robot's state machine for one frame.
+
+    Args:
+    - state (int): Robot state code.
+    - action (int): Current robot action code.
+    - events (int): Event bits of the frame.
+
+    Returns:
+    - tuple: Next action, timer and rotation, or None if the action continues unchanged.
+    """
+    if state == OFF:
+        return None if action == STOP else (STOP, TIMER_KEEP, ROTATE_KEEP)  # If robot is off, it should stop
+    if action == STOP:
+        if events & TIMER_EXPIRED:
+            return GO, TIMER_NONE, ROTATE_KEEP  # If stopped, switch to 'go', the earlier action's time limit is over
+        return GO, TIMER_KEEP, ROTATE_KEEP  # If stopped, switch to 'go'
+    if action == PAUSE:
+        return PAUSE, TIMER_NONE, ROTATE_KEEP  # Stop any ongoing action
+    if action == GO:
+        # A line takes precedence over an obstacle
+        if events & LINE_LEFT:
+            return BACK, TIMER_BACK, ROTATE_LEFT  # Line detected on the left, move back rotating left
+        if events & LINE_RIGHT:
+            return BACK, TIMER_BACK, ROTATE_RIGHT  # Line detected on the right, move back rotating right
+        if events & OBSTACLE_FRONT:
+            return AVOID, TIMER_AVOID, ROTATE_RANDOM  # Switch to avoidance if an obstacle is detected
+    elif action == BACK:
+        if events & OBSTACLE_BACK:
+            return AVOID, TIMER_AVOID, ROTATE_RANDOM  # Switch to avoidance if an obstacle is detected
+        if events & TIMER_EXPIRED:
+            return AVOID, TIMER_AVOID, ROTATE_KEEP  # Back action completed, switch to avoidance
+        return None
+    if events & TIMER_EXPIRED:
+        return GO, TIMER_NONE, ROTATE_KEEP  # Avoidance completed, resume normal operation
+    return None
+
+def build_transitions():
+    """
+    Precompute the transitions of the state machine for every state, action and event combination.
+
+    Returns:
+    - np.ndarray: Next action, timer and rotation indexed by state, action and event bits, action -1 if unchanged.
+    """
+    transitions = np.full((len(STATES), len(ACTIONS), TIMER_EXPIRED << 1, 3), -1, dtype=np.int64)
+    for state in range(len(STATES)):
+        for action in range(len(ACTIONS)):
+            for events in range(TIMER_EXPIRED << 1):
+                next_transition = transition(state, action, events)
+                if next_transition is not None:
+                    transitions[state, action, events] = next_transition
+    return transitions
+
+TRANSITIONS = build_transitions()  # Transition table, precomputed once
+
+@njit(cache=True)
+def step(state, action, prox_front, prox_back, prox_ground, now, action_start_time, action_duration,
+         rotation_direction, back_duration, avoid_durations, rotations, random_index, transitions):
+    """
+    Run one frame of the robot's state machine.
+
+    Args:
+    - state (int): Robot state code.
+    - action (int): Current robot action code.
+    - prox_front (np.ndarray): Front proximity sensor values, used when going.
+    - prox_back (np.ndarray): Back proximity sensor values, used when backing up.
+    - prox_ground (np.ndarray): Ground sensor values, used when going.
+    - now (float): Monotonic time of the frame.
+    - action_start_time (float): Timestamp for when the current action started.
+    - action_duration (float): Duration for which the current action runs, 0 without a time limit.
+    - rotation_direction (int): Direction of rotation (1 for left, -1 for right).
+    - back_duration (float): Fixed duration of the 'back' action.
+    - avoid_durations (np.ndarray): Random avoidance durations drawn ahead of time.
+    - rotations (np.ndarray): Random rotation directions drawn ahead of time.
+    - random_index (int): Index of the next random draws.
+    - transitions (np.ndarray): Transition table from build_transitions.
+
+    Returns:
+    - tuple: Updated action, action_start_time, action_duration, rotation_direction and random_index.
+    """
+    # Collect the event bits of this frame
+    events = 0
+    if state == ON:
+        if action == GO:
+            if detect_obstacle(prox_front):
+                events |= OBSTACLE_FRONT
+            line_detection = detect_line(prox_ground)
+            if line_detection == 1:
+                events |= LINE_LEFT
+            elif line_detection == 2:
+                events |= LINE_RIGHT
+        elif action == BACK:
+            if detect_obstacle(prox_back):
+                events |= OBSTACLE_BACK
+        if action_duration > 0 and now - action_start_time > action_duration:
+            events |= TIMER_EXPIRED
+
+    # Look up and apply the transition
+    next_transition = transitions[state, action, events]
+    if next_transition[0] >= 0:
+        action = next_transition[0]
+        timer = next_transition[1]
+        rotation = next_transition[2]
+        if timer == TIMER_NONE:
+            action_duration = 0.0
+        elif timer != TIMER_KEEP:
+            # Random duration for avoidance, fixed duration for backing up
+            action_duration = avoid_durations[random_index] if timer == TIMER_AVOID else back_duration
+            action_start_time = now  # Record start time for the action
+        if rotation == ROTATE_RANDOM:
+            rotation_direction = rotations[random_index]  # Randomize rotation direction
+        elif rotation != ROTATE_KEEP:
+            rotation_direction = rotation
+        if timer == TIMER_AVOID:
+            random_index = (random_index + 1) & 1023  # Next draws for the next avoidance
+    return action, action_start_time, action_duration, rotation_direction, random_index
+
+def pin_to_cpu(cpu):
+    """
+    Pin the calling process to a CPU core.
+
+    Keeps running on all cores if the core is not available (e.g. on a single-core board).
+
+    Args:
+    - cpu (int): CPU core to run on.
+    """
+    try:
+        os.sched_setaffinity(0, {cpu})
+    except (OSError, AttributeError) as error:
+        print(f'CPU pinning not available: {error}')
+
+def variable_writer(thymio_handler, robot, names):
+    """
+    Build a writer that sets several Thymio variables at once.
+
+    Variables that are adjacent in the Thymio variable memory are sent in a single SET_VARIABLES message,
+    otherwise each variable is set on its own.
+
+    Args:
+    - thymio_handler (Thymio): Connected Thymio handler.
+    - robot: Thymio node the variables belong to.
+    - names (list): Names of the variables in memory order.
+
+    Returns:
+    - function: Writer taking the values of all variables as one flat list.
+    """
+    try:
+        offsets = [thymio_handler.variable_offset(robot.id, name) for name in names]
+        sizes = [thymio_handler.variable_size(robot.id, name) for name in names]
+        connection = thymio_handler.thymio_proxy.connection
+        node = connection.remote_nodes[robot.id]
+    except (AttributeError, KeyError):
+        # The variable layout is not known, take the sizes from the current values and set each variable on its own
+        offsets = None
+        sizes = [len(value) if isinstance(value, list) else 1 for value in (robot[name] for name in names)]
+
+    adjacent = offsets is not None and all(
+        offset + size == next_offset for offset, size, next_offset in zip(offsets, sizes, offsets[1:])
+    )
+    if adjacent:
+        start = offsets[0]
+        lock = connection.input_lock
+        def write(values):
+            with lock:  # Keep the local copy in sync, as thymiodirect does when setting a variable
+                node.var_data[start:start + len(values)] = values
+            connection.set_variables(robot.id, start, values)  # One serial message for all variables
+        return write
+
+    def write(values):
+        start = 0
+        for name, size in zip(names, sizes):
+            robot[name] = values[start:start + size] if size > 1 else values[start]
+            start += size
+    return write
+
+def variable_reader(thymio_handler, robot, name):
+    """
+    Build a reader that copies a Thymio array variable into a preallocated buffer.
+
+    The values are copied straight from the variable cache of the Thymio connection when its layout is known,
+    otherwise they are read through the node.
+
+    Args:
+    - thymio_handler (Thymio): Connected Thymio handler.
+    - robot: Thymio node the variable belongs to.
+    - name (str): Name of the variable.
+
+    Returns:
+    - function: Reader taking the buffer to fill, a numpy array of the variable's size.
+    """
+    try:
+        connection = thymio_handler.thymio_proxy.connection
+        node = connection.remote_nodes[robot.id]
+        start = node.var_offset[name]
+        end = start + node.var_size[name]
+    except (AttributeError, KeyError):
+        def read(out):
+            out[:] = robot[name]
+        return read
+
+    lock = connection.input_lock
+    def read(out):
+        with lock:  # The cache is updated by the Thymio connection thread
+            out[:] = node.var_data[start:end]
+    return read
+
+def write_command(commands, slot, code):
+    """
+    Publish the latest command of a slot to the control process.
+
+    Args:
+    - commands (np.ndarray): Shared command words.
+    - slot (int): Command slot to write.
+    - code (int): Code of the command.
+    """
+    sequence = (int(commands[slot]) >> 8) + 1 & 0xFFFFFF  # Only the comms process writes, so no compare-and-swap is needed
+    commands[slot] = sequence << 8 | code
+
+def receive_commands(shm, robot_id, robot_topic, ip, port, wake):
+    """
+    Comms process, receive the ZMQ commands and keep the latest one of each slot in shared memory.
+
+    Args:
+    - shm (shared_memory.SharedMemory): Shared memory holding the command words.
+    - robot_id (str): ID of the robot for ZMQ communication.
+    - robot_topic (bytes): Topic of the messages handled as commands for this robot, the Thymio node ID.
+    - ip (str): IP address for the ZMQ socket.
+    - port (int): Port number for the ZMQ socket.
+    - wake (multiprocessing.connection.Connection): Pipe end used to wake the control process.
+    """
+    pin_to_cpu(comms_cpu)
+    try:
+        os.nice(comms_nice)
+    except OSError as error:
+        print(f'Process priority not available: {error}')
+    commands = np.ndarray(COMMAND_SLOTS, dtype=np.uint32, buffer=shm.buf)
+
+    # Create a ZMQ context and subscriber socket for communication
+    context = zmq.Context()
+    zmq_socket = context.socket(zmq.SUB)
+    zmq_socket.setsockopt(zmq.RCVBUF, 64 * 1024)  # Kernel receive buffer of the TCP connection
+    try:
+        zmq_socket.setsockopt(zmq.BUSY_POLL, 1)  # Busy-poll the TCP socket, only in libzmq builds with the draft API
+    except zmq.ZMQError:
+        pass
+    zmq_socket.connect(f'tcp://{ip}:{port}')  # Connect to the specified IP and port
+
+    # Subscribe to specific topics for receiving messages
+    zmq_socket.setsockopt(zmq.SUBSCRIBE, TOPIC_ALL)  # Subscribe to all robots
+    zmq_socket.setsockopt(zmq.SUBSCRIBE, TOPIC_LED)  # Subscribe to LED control messages
+    zmq_socket.setsockopt_string(zmq.SUBSCRIBE, robot_id)  # Subscribe to messages for this specific robot
+
+    try:
+        pending = False  # A command was written since the control process was last woken
+        while True:
+            topic, data = zmq_socket.recv_multipart()  # Block until the next message, topic and data frames
+
+            # Process messages for different topics, commands this controller does not know are ignored
+            if topic == TOPIC_ALL and data in STATE_CODES:  # Message for all robots
+                write_command(commands, COMMAND_STATE, STATE_CODES[data])
+                pending = True
+            elif topic == robot_topic:  # Message for this specific robot
+                print(data.decode(), robot_topic.decode())  # Debugging output
+                if data == b'on':
+                    write_command(commands, COMMAND_STATE, STATE_CODES[b'on'])  # Set robot state to on
+                    pending = True
+                elif data in ACTION_CODES:
+                    write_command(commands, COMMAND_ACTION, ACTION_CODES[data])  # Update robot action
+                    pending = True
+            elif topic == TOPIC_LED:  # LED control messages, unknown patterns turn off all LEDs
+                write_command(commands, COMMAND_LED, LED_CODES.get(data, 0))
+                pending = True
+
+            # Wake the control process once per burst, after the messages that already arrived are handled
+            if pending and not zmq_socket.getsockopt(zmq.EVENTS) & zmq.POLLIN:
+                wake.send_bytes(b'')
+                pending = False
+    except KeyboardInterrupt:
+        pass
+    finally:
+        del commands  # Release the view before closing the shared memory
+        shm.close()
+        zmq_socket.close()
+        context.term()
+
+def pace(next_deadline, dt, wake):
+    """
+    Wait for the next frame of the fixed-rate control loop, frames that were overrun are dropped.
+
+    Args:
+    - next_deadline (float): perf_counter time at which the next frame is due.
+    - dt (float): Frame period in seconds.
+    - wake (multiprocessing.connection.Connection): Pipe end of the comms process, a command ends the wait early.
+
+    Returns:
+    - float: Deadline of the frame after the one that is started now.
+    """
+    remaining = next_deadline - time.perf_counter()
+    if remaining <= 0:
+        # Overrun, skip ahead to the next slot instead of running the missed frames back to back
+        return next_deadline + (math.floor(-remaining / dt) + 1) * dt
+    if wake.poll(remaining):
+        return next_deadline  # Handle the command right away, the frame slot stays the same
+    return next_deadline + dt
+
 def main(robot_id='0', ip='localhost', port=5556):
     """
-    Main loop of the program to control a Thymio robot.
+    Control process of a Thymio robot, reads the sensors and drives the motors and LEDs.
+
+    The ZMQ commands are received by a separate comms process, so the control loop never waits on the network.
 
     Args:
     - robot_id (str): ID of the robot for ZMQ communication.
     - ip (str): IP address for the ZMQ socket.
     - port (int): Port number for the ZMQ socket.
     """
+    shm = None    # Shared memory of the commands
+    comms = None  # Comms process receiving the commands
     try:
         # Initialize and connect to the robot using Thymio's direct connection
         thymio_handler = Thymio(
@@ -54,137 +439,109 @@ def main(robot_id='0', ip='localhost', port=5556):
         )
         thymio_handler.connect()  # Establish connection to the robot
         robot = thymio_handler.first_node()  # Get the first connected Thymio robot
+        robot_topic = str(robot.id).encode()  # Topic frame of the commands for this robot, converted once
+
+        # Set the motors and the LEDs of one decision with as few serial messages as possible
+        write_motors = variable_writer(thymio_handler, robot, ['motor.left.target', 'motor.right.target'])
+        write_leds = variable_writer(thymio_handler, robot, ['leds.top', 'leds.bottom.left', 'leds.bottom.right'])
+        write_leds_circle = variable_writer(thymio_handler, robot, ['leds.top', 'leds.bottom.left', 'leds.bottom.right', 'leds.circle'])
+        read_prox_horizontal = variable_reader(thymio_handler, robot, 'prox.horizontal')
+        read_prox_ground = variable_reader(thymio_handler, robot, 'prox.ground.reflected')
+
+        # Start the comms process, a fresh interpreter so it shares neither the GIL nor the Thymio connection
+        shm = shared_memory.SharedMemory(create=True, size=COMMAND_SLOTS * 4)
+        commands = np.ndarray(COMMAND_SLOTS, dtype=np.uint32, buffer=shm.buf)
+        commands[:] = 0
+        spawn = multiprocessing.get_context('spawn')
+        wake, wake_sender = spawn.Pipe(duplex=False)
+        comms = spawn.Process(target=receive_commands, args=(shm, robot_id, robot_topic, ip, port, wake_sender), daemon=True)
+        comms.start()
+        pin_to_cpu(control_cpu)
+        last_commands = commands.tolist()  # Command words last applied
 
-        # Create a ZMQ context and subscriber socket for communication
-        context = zmq.Context()
-        zmq_socket = context.socket(zmq.SUB)
-        zmq_socket.connect(f'tcp://{ip}:{port}')  # Connect to the specified IP and port
-        
-        # Subscribe to specific topics for receiving messages
-        zmq_socket.setsockopt_string(zmq.SUBSCRIBE, 'all')  # Subscribe to all robots
-        zmq_socket.setsockopt_string(zmq.SUBSCRIBE, 'led')  # Subscribe to LED control messages
-        zmq_socket.setsockopt_string(zmq.SUBSCRIBE, robot_id)  # Subscribe to messages for this specific robot
+        # Wait for the next frame or a command instead of spinning
+        frame_period = 0.01  # Run the control loop at 100 Hz
 
         # Robot configuration and control variables
         robot_speed = 250            # Maximum speed of the robot
-        action_start_time = 0        # Timestamp for when the current action starts
-        action_duration = 0          # Duration for which the current action will run
-        back_duration = 1            # Fixed duration for the 'back' action
+        action_start_time = 0.0      # Timestamp for when the current action starts
+        action_duration = 0.0        # Duration for which the current action will run
+        back_duration = 1.0          # Fixed duration for the 'back' action
         rotation_direction = 0       # Direction of rotation (1 for left, -1 for right)
 
-        robot_action = 'stop'        # Initial action state of the robot
-        robot_state = 'off'          # Initial state of the robot (off)
+        robot_action = STOP          # Initial action state of the robot
+        robot_state = OFF            # Initial state of the robot (off)
+        last_led = None              # LED pattern last applied to the robot
+        last_motor_targets = None    # Motor targets last sent to the robot
 
+        # Sensor buffers reused across frames, the proximity and ground readings are never negative
+        prox_horizontal = np.zeros(7, dtype=np.uint16)
+        prox_ground = np.zeros(2, dtype=np.uint16)
+        prox_front = prox_horizontal[:5]  # Views of the front and back sensors, sliced once
+        prox_back = prox_horizontal[5:]
+
+        # Random avoidance durations and rotation directions drawn ahead of time and used in turn
+        rng = np.random.default_rng()
+        avoid_durations = rng.uniform(0.5, 1.5, size=1024)
+        rotations = rng.choice((-1, 1), size=1024)
+        random_index = 0
+
+        # Compile the state machine step before the first frame, so the first frame does not wait for the JIT
+        step(robot_state, robot_action, prox_front, prox_back, prox_ground, 0.0, action_start_time, action_duration,
+             rotation_direction, back_duration, avoid_durations, rotations, random_index, TRANSITIONS)
+
+        # The action timer runs on the monotonic clock, so a clock adjustment cannot end or stretch an action
+        clock = time.monotonic
+
+        next_frame = time.perf_counter()
         while True:
-            # Receive and process data from the ZMQ socket
-            try:
-                topic, data = zmq_socket.recv(flags=zmq.NOBLOCK).decode('utf-8').split()
-                
-                # Process messages for different topics
-                if topic == 'all':  # Message for all robots
-                    robot_state = data
-                elif topic == str(robot.id):  # Message for this specific robot
-                    if data == 'on':
-                        robot_state = 'on'  # Set robot state to on
-                    else:
-                        robot_action = data  # Update robot action based on received message
-                    print(robot_action, robot.id)  # Debugging output
-                elif topic == 'led':  # Handle LED control messages
-                    if data == '1':
-                        # Set LEDs to a bright white color
-                        robot['leds.top'] = [32, 32, 32]
-                        robot['leds.bottom.left'] = [32, 32, 32]
-                        robot['leds.bottom.right'] = [32, 32, 32]
-                        robot['leds.circle'] = [32, 32, 32, 32, 32, 32, 32, 32]
-                    elif data == '2':
-                        # Set LEDs to green
-                        robot['leds.top'] = [0, 32, 0]
-                        robot['leds.bottom.left'] = [0, 32, 0]
-                        robot['leds.bottom.right'] = [0, 32, 0]
-                    elif data == '3':
-                        # Set LEDs to red
-                        robot['leds.top'] = [32, 0, 0]
-                        robot['leds.bottom.left'] = [32, 0, 0]
-                        robot['leds.bottom.right'] = [32, 0, 0]
-                    elif data == '4':
-                        # Set LEDs to blue
-                        robot['leds.top'] = [0, 0, 32]
-                        robot['leds.bottom.left'] = [0, 0, 32]
-                        robot['leds.bottom.right'] = [0, 0, 32]
-                    else:
-                        # Turn off all LEDs
-                        robot['leds.top'] = [0, 0, 0]
-                        robot['leds.bottom.left'] = [0, 0, 0]
-                        robot['leds.bottom.right'] = [0, 0, 0]
-                        robot['leds.circle'] = [0, 0, 0, 0, 0, 0, 0, 0]
-            except zmq.Again:
-                # No message available; continue to the next loop iteration
-                pass
-
-            # Handle the robot's state and determine actions
-            if robot_state == 'off':
-                robot_action = 'stop'  # If robot is off, it should stop
-            elif robot_state == 'on':
-                if robot_action == 'stop':
-                    robot_action = 'go'  # If stopped, switch to 'go'
-                elif robot_action == 'pause':
-                    action_duration = 0  # Stop any ongoing action
-                elif robot_action == 'go':
-                    # Check for obstacles and react accordingly
-                    if detect_obstacle(robot['prox.horizontal'][:5]):
-                        robot_action = 'avoid'  # Switch to avoidance if an obstacle is detected
-                        action_duration = random.uniform(0.5, 1.5)  # Random duration for avoidance
-                        rotation_direction = random.choice([-1, 1])  # Randomize rotation direction
-                        action_start_time = time.time()  # Record start time for the action
-                    # Check for line detection
-                    line_detection = detect_line(robot['prox.ground.reflected'])
-                    if line_detection == 1:
-                        robot_action = 'back'  # Line detected on the left, move back
-                        action_duration = back_duration
-                        rotation_direction = 1  # Rotate left while backing up
-                        action_start_time = time.time()
-                    elif line_detection == 2:
-                        robot_action = 'back'  # Line detected on the right, move back
-                        action_duration = back_duration
-                        rotation_direction = -1  # Rotate right while backing up
-                        action_start_time = time.time()
-                elif robot_action == 'back':
-                    # Check for obstacles while backing up
-                    if detect_obstacle(robot['prox.horizontal'][-2:]):
-                        robot_action = 'avoid'  # Switch to avoidance if an obstacle is detected
-                        action_duration = random.uniform(0.5, 1.5)  # Random duration for avoidance
-                        rotation_direction = random.choice([-1, 1])
-                        action_start_time = time.time()
-
-                # Check if the current action's time limit has been exceeded
-                if action_duration > 0 and time.time() - action_start_time > action_duration:
-                    if robot_action == 'back':
-                        # Back action completed, switch to avoidance
-                        robot_action = 'avoid'
-                        action_duration = random.uniform(0.5, 1.5)  # Randomize avoidance duration
-                        action_start_time = time.time()
+            # Apply the latest command of each slot that was written since the last frame
+            while wake.poll():
+                wake.recv_bytes()  # Clear the wake-ups of the commands applied now
+            state_word, action_word, led_word = commands.tolist()
+            last_state_word, last_action_word, last_led_word = last_commands
+            last_commands = [state_word, action_word, led_word]
+
+            if state_word != last_state_word:
+                robot_state = state_word & 0xFF
+            if action_word != last_action_word:
+                robot_action = action_word & 0xFF
+
+            if led_word != last_led_word:
+                led = LED_PATTERNS[led_word & 0xFF]
+                if led is not last_led:  # Skip a repeated pattern
+                    last_led = led
+                    color, circle = led
+                    if circle is None:
+                        write_leds(color * 3)  # Top, bottom left and bottom right
                     else:
-                        # Avoidance or pause completed, resume normal operation
-                        robot_action = 'go'
-                        action_duration = 0
-
-            # Execute the robot's current action based on the state
-            if robot_action == 'go':
-                # Move forward at set speed
-                robot['motor.left.target'] = robot_speed
-                robot['motor.right.target'] = robot_speed
-            elif robot_action == 'avoid':
-                # Rotate in the opposite direction to avoid obstacle
-                robot['motor.left.target'] = rotation_direction * robot_speed
-                robot['motor.right.target'] = -rotation_direction * robot_speed
-            elif robot_action == 'back':
-                # Move backward at set speed
-                robot['motor.left.target'] = -robot_speed
-                robot['motor.right.target'] = -robot_speed
-            elif robot_action in ('stop', 'pause'):
-                # Stop all motors when stopping or pausing
-                robot['motor.left.target'] = 0
-                robot['motor.right.target'] = 0
+                        write_leds_circle(color * 3 + circle)
+
+            # Read the sensors once per frame, only in the actions that use them
+            if robot_state == ON:
+                if robot_action == GO:
+                    read_prox_horizontal(prox_horizontal)
+                    read_prox_ground(prox_ground)
+                elif robot_action == BACK:
+                    read_prox_horizontal(prox_horizontal)
+
+            # Run the compiled state machine, only the robot I/O stays in the interpreter
+            robot_action, action_start_time, action_duration, rotation_direction, random_index = step(
+                robot_state, robot_action, prox_front, prox_back, prox_ground, clock(), action_start_time,
+                action_duration, rotation_direction, back_duration, avoid_durations, rotations, random_index,
+                TRANSITIONS
+            )
+
+            # Execute the robot's current action
+            motor_targets = ACTION_MOTORS[robot_action](robot_speed, rotation_direction)
+
+            # Only send the motor targets to the robot when they change
+            if motor_targets != last_motor_targets:
+                last_motor_targets = motor_targets
+                write_motors(list(motor_targets))
+
+            # Sleep for the rest of the frame
+            next_frame = pace(next_frame, frame_period, wake)
 
     except Exception as error:
         # Handle unexpected errors by stopping the robot
@@ -196,6 +553,15 @@ def main(robot_id='0', ip='localhost', port=5556):
         robot['motor.left.target'] = 0
         robot['motor.right.target'] = 0
         print('Keyboard Interrupt')  # Inform user about the interruption
+    finally:
+        # Stop the comms process and release the shared memory
+        if comms is not None:
+            comms.terminate()
+            comms.join()
+        if shm is not None:
+            commands = None  # Release the view before closing the shared memory
+            shm.close()
+            shm.unlink()
 
 if __name__ == '__main__':
     # Parse command-line arguments to configure the robot's connection